@@ -0,0 +1,137 @@
+"""
+Benchmark of forms made by `model_form()` against in-memory SQLite.
+
+Times every phase of a form's life: making the form class, instantiating
+it, processing POST data, validating and rendering, and counts SQL queries
+issued in each phase.  Results are printed as JSON, so runs of different
+versions can be compared.
+
+Run from the repository root, e.g.::
+
+    PYTHONPATH=. python benchmarks/bench_forms.py --columns 40 --choices 200
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+import gluon
+from gluon import DAL, Field
+
+import wtforms_web2py
+from wtforms_web2py.dal import model_form
+
+
+COLUMN_TYPES = [
+    ("string", "some text"),
+    ("integer", "42"),
+    ("text", "some longer text"),
+    ("boolean", "on"),
+    ("double", "1.5"),
+    ("date", "2012-12-21"),
+]
+
+
+class PostData(dict):
+    def getlist(self, key):
+        return [self[key]]
+
+
+class QueryCounter(object):
+
+    """
+    Counts SQL statements executed by `db`.
+    """
+
+    def __init__(self, db):
+        self.count = 0
+        execute = db._adapter.execute
+        def counting_execute(*args, **kwargs):
+            self.count += 1
+            return execute(*args, **kwargs)
+        db._adapter.execute = counting_execute
+
+
+def define_tables(db, columns, references, choices):
+    db.define_table("choice", Field("name"))
+    for i in range(choices):
+        db.choice.insert(name="Choice %d" % i)
+    fields = []
+    post = {}
+    for i in range(references):
+        name = "ref%d" % i
+        fields.append(Field(name, "reference choice"))
+        post[name] = str(choices // 2 or 1)
+    for i in range(columns - references):
+        field_type, value = COLUMN_TYPES[i % len(COLUMN_TYPES)]
+        name = "col%d" % i
+        fields.append(Field(name, field_type))
+        post[name] = value
+    return db.define_table("item", *fields), PostData(post)
+
+
+def run_once(table, post, counter, options):
+    phases = []
+    def phase(name, f):
+        queries = counter.count
+        t0 = time.time()
+        result = f()
+        phases.append((name, time.time() - t0, counter.count - queries))
+        return result
+
+    F = phase("model_form", lambda: model_form(table, cache=options.cache))
+    phase("instantiate", F)
+    form = phase("process", lambda: F(post))
+    phase("validate", form.validate)
+    phase("render", lambda: [field.xml() for field in form])
+    return phases
+
+
+def run(options):
+    db = DAL("sqlite:memory")
+    gluon.current.globalenv = {"db": db}
+    table, post = define_tables(db, options.columns, options.references,
+                                options.choices)
+    counter = QueryCounter(db)
+
+    results = {}
+    for i in range(options.repeat):
+        for name, seconds, queries in run_once(table, post, counter, options):
+            result = results.setdefault(name, {"seconds": [], "queries": queries})
+            result["seconds"].append(seconds)
+
+    phases = {}
+    for name, result in results.items():
+        seconds = sorted(result["seconds"])
+        phases[name] = {
+            "min": seconds[0],
+            "median": seconds[len(seconds) // 2],
+            "queries": result["queries"],
+        }
+    return {
+        "benchmark": "forms",
+        "python": platform.python_version(),
+        "params": vars(options),
+        "phases": phases,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--columns", type=int, default=20,
+                        help="number of fields in the table")
+    parser.add_argument("--references", type=int, default=3,
+                        help="how many of the fields are references")
+    parser.add_argument("--choices", type=int, default=100,
+                        help="number of rows in the referenced table")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--cache", action="store_true",
+                        help="make form classes with model_form(cache=True)")
+    options = parser.parse_args(argv)
+    json.dump(run(options), sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Memory benchmark of form instances made from `model_form()` classes.
+
+Counts objects allocated by instantiating and processing a form, and sums
+their sizes, per form instance.  Only objects tracked by the garbage
+collector (containers and instances) are seen, which is most of a form's
+footprint.  Results are printed as JSON, so runs of different versions can
+be compared.
+
+Bound fields reference validators, filters, widgets and descriptions of
+their unbound field, but each has its own `Label`, `Flags` and ``__dict__``,
+since applications change them per request.  So ``objects`` grows with the
+number of fields, and state kept in the fields shows in ``bytes``.  Options
+of `QuerySelectField` are the only field metadata shared by instances in a
+separate structure.
+
+Run from the repository root, e.g.::
+
+    PYTHONPATH=. python benchmarks/bench_memory.py --columns 40 --references 10
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+
+import gluon
+from gluon import DAL
+
+import wtforms_web2py
+from wtforms_web2py.dal import model_form
+
+from bench_forms import define_tables
+
+
+def _size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__') and not isinstance(obj, type):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def measure(make, count):
+    """
+    Returns ``(objects, bytes)`` allocated per result of `make()`, kept
+    alive `count` times.
+    """
+    gc.collect()
+    before = set(id(obj) for obj in gc.get_objects())
+    kept = [make() for i in range(count)]
+    gc.collect()
+    objects = gc.get_objects()
+    new = [obj for obj in objects
+           if id(obj) not in before and obj is not kept and obj is not before]
+    size = sum(_size(obj) for obj in new)
+    del kept
+    return len(new) / float(count), size / float(count)
+
+
+def run(options):
+    db = DAL("sqlite:memory")
+    gluon.current.globalenv = {"db": db}
+    table, post = define_tables(db, options.columns, options.references,
+                                options.choices)
+    F = model_form(table)
+    F()  # Class-level structures are made on first instantiation.
+
+    phases = {}
+    for name, make in (("instantiate", F), ("process", lambda: F(post))):
+        objects, size = measure(make, options.forms)
+        phases[name] = {"objects": objects, "bytes": size}
+    return {
+        "benchmark": "memory",
+        "python": platform.python_version(),
+        "params": vars(options),
+        "phases": phases,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--columns", type=int, default=20,
+                        help="number of fields in the table")
+    parser.add_argument("--references", type=int, default=10,
+                        help="how many of the fields are references")
+    parser.add_argument("--choices", type=int, default=10,
+                        help="number of rows in the referenced table")
+    parser.add_argument("--forms", type=int, default=200,
+                        help="number of form instances kept alive")
+    options = parser.parse_args(argv)
+    json.dump(run(options), sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# encoding: utf-8
+"""
+Micro-benchmark of text coercion done by `wtforms_web2py.compat.text_type`
+compared to its previous implementation.
+
+Run from the repository root as ``PYTHONPATH=. python benchmarks/bench_text.py``.
+"""
+import timeit
+
+import wtforms_web2py
+from wtforms_web2py.compat import ForgivingUnicode
+from wtforms_web2py.utils import force_unicode
+
+
+class OldForgivingUnicode(unicode):
+    def __new__(cls, val):
+        unicoded_val = force_unicode(val, 'utf-8')
+        return super(OldForgivingUnicode, cls).__new__(cls, unicoded_val)
+    def __str__(self):
+        return self.encode('utf-8')
+
+
+VALUES = [
+    ('unicode', u'Customer name'),
+    ('ascii str', 'Customer name'),
+    ('utf-8 str', 'Имя покупателя'),
+    ('text_type', ForgivingUnicode(u'Customer name')),
+    ('int', 42),
+]
+
+
+def coerce(cls, value):
+    return lambda: cls(value)
+
+
+def coerce_and_encode(cls, value):
+    def f():
+        text = cls(value)
+        str(text)
+        str(text)
+        str(text)
+    return f
+
+
+def measure(f, number):
+    return min(timeit.Timer(f).repeat(3, number)) / number * 1e6
+
+
+def run(number=100000):
+    print '%-30s %10s %10s' % ('case', 'old, usec', 'new, usec')
+    for value_name, value in VALUES:
+        for case in (coerce, coerce_and_encode):
+            print '%-30s %10.3f %10.3f' % (
+                '%s: %s' % (value_name, case.__name__),
+                measure(case(OldForgivingUnicode, value), number),
+                measure(case(ForgivingUnicode, value), number))
+
+
+if __name__ == '__main__':
+    run()
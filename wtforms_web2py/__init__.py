@@ -12,5 +12,12 @@ sys.modules['wtforms.compat'] = compat
 #       Also web2py's templates need `str` instead of `unicode`.
 from wtforms.fields.core import Field
 from wtforms.widgets.core import HTMLString
-Field.xml = lambda self: Field.__html__(self).encode('utf-8')
-HTMLString.xml = lambda self: HTMLString.__html__(self).encode('utf-8')
+def _to_utf8(html):
+    # ForgivingUnicode keeps its encoded form, so it's encoded once.
+    if isinstance(html, compat.ForgivingUnicode):
+        return str(html)
+    return html.encode('utf-8')
+# `xml()` also adds HTML5 attributes of client-side constraints.
+from wtforms_web2py.constraints import html_attributes
+Field.xml = lambda self: _to_utf8(self(**html_attributes(self)))
+HTMLString.xml = lambda self: _to_utf8(HTMLString.__html__(self))
@@ -0,0 +1,91 @@
+"""
+Validation of many records, e.g. bulk imports, with a form class.
+"""
+from .fields import QuerySelectField
+from .validators import Unique
+
+
+class _RecordData(dict):
+
+    """
+    Record as form data.  Values may be single values or lists.  It's always
+    true, so fields missing from the record are processed as empty.
+    """
+
+    def __nonzero__(self):
+        return True
+
+    def __contains__(self, key):
+        return dict.get(self, key) is not None
+
+    def getlist(self, key):
+        value = self[key]
+        return value if isinstance(value, (list, tuple)) else [value]
+
+
+def _choice_pks(data, name):
+    if name not in data:
+        return []
+    pks = []
+    for value in data.getlist(name):
+        try:
+            pks.append(int(value))
+        except (TypeError, ValueError):
+            pass
+    return pks
+
+
+def _chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(_RecordData(record))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def validate_records(form_class, records, chunk_size=1000):
+    """
+    Validates `records` (dicts of field name -> value) with `form_class` and
+    yields ``(index, data, errors)`` for each record, where ``errors`` is
+    empty for a valid record.
+
+    A single form instance is reused for all records, so validators and
+    loaded choices are shared between them.  Choices of `QuerySelectField`s
+    and values checked by `Unique` validators are selected with one
+    ``belongs()`` query per field for each chunk of `chunk_size` records,
+    instead of queries per record.  A value checked by `Unique` is rejected
+    also if a valid record before it in `records` has it.
+    """
+    form = form_class()
+    query_fields = [field for field in form
+                    if isinstance(field, QuerySelectField)]
+    unique_checks = [(field, validator) for field in form
+                     for validator in field.validators
+                     if isinstance(validator, Unique)]
+    index = 0
+    for chunk in _chunks(records, chunk_size):
+        for field in query_fields:
+            # Keeps only rows of the current chunk.
+            field._lookups = None
+            pks = []
+            for data in chunk:
+                pks.extend(_choice_pks(data, field.name))
+            field.prefetch(pks)
+        for field, validator in unique_checks:
+            field._unique_found = {}
+        for field, validator in unique_checks:
+            validator.prefetch(field, [data.getlist(field.name)[0]
+                                       for data in chunk if field.name in data])
+        for data in chunk:
+            form.process(data)
+            if form.validate():
+                for field, validator in unique_checks:
+                    validator.reserve(field, field.data,
+                                      validator._record_id(form))
+                yield index, form.data, {}
+            else:
+                yield index, form.data, form.errors
+            index += 1
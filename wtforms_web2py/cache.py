@@ -0,0 +1,189 @@
+import hashlib
+import re
+import threading
+import time
+import types
+from collections import OrderedDict
+
+
+class MemoryCache(object):
+
+    """
+    In-process LRU cache with the interface of web2py cache models.
+
+    Like ``cache.ram`` it's called as ``cache(key, f, time_expire)``, and
+    ``cache(key, None)`` removes the key.  Unlike ``cache.ram`` it holds at
+    most `maxsize` entries, dropping the least recently used ones.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.storage = OrderedDict()
+        self.locker = threading.Lock()
+
+    def __call__(self, key, f, time_expire=None):
+        now = time.time()
+        with self.locker:
+            item = self.storage.pop(key, None)
+            if f is None:
+                return None
+            if item is not None and (time_expire is None or
+                                     item[0] > now - time_expire):
+                # Re-inserting moves the key to the most recently used end.
+                self.storage[key] = item
+                return item[1]
+        value = f()
+        with self.locker:
+            self.storage[key] = (now, value)
+            while len(self.storage) > self.maxsize:
+                self.storage.popitem(last=False)
+        return value
+
+    def clear(self, regex=None):
+        with self.locker:
+            if regex is None:
+                self.storage.clear()
+            else:
+                r = re.compile(regex)
+                for key in self.storage.keys():
+                    if r.match(key):
+                        del self.storage[key]
+
+
+class _Invalidator(object):
+
+    """
+    DAL ``_after_insert``/``_after_update``/``_after_delete`` callback which
+    drops cached choices of a table.
+    """
+
+    def __init__(self, choice_cache, tablename):
+        self.choice_cache = choice_cache
+        self.tablename = tablename
+
+    def __call__(self, *args):
+        self.choice_cache.invalidate(self.tablename)
+
+    def __eq__(self, other):
+        return (isinstance(other, _Invalidator) and
+                self.choice_cache is other.choice_cache and
+                self.tablename == other.tablename)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def callable_key(f):
+    """
+    Returns a string identifying callable `f` which is stable between
+    requests and processes.
+    """
+    key = getattr(f, 'cache_key', None)
+    if key is not None:
+        return key
+    code = getattr(f, '__code__', None)
+    if code is not None:
+        return '%s:%s:%s' % (code.co_filename, code.co_firstlineno, code.co_name)
+    return '%s.%s' % (type(f).__module__, type(f).__name__)
+
+
+def _value_key(value):
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        keys = [_value_key(x) for x in value]
+        if None not in keys:
+            return '(%s)' % ', '.join(keys)
+    return None
+
+
+def loader_key(f):
+    """
+    Returns `callable_key(f)` extended with values `f` closes over and its
+    defaults, so closures made by one factory get different keys.  Returns
+    None if `f` can't be keyed reliably, e.g. a bound method or a closure
+    over something else than plain values.
+    """
+    key = getattr(f, 'cache_key', None)
+    if key is not None:
+        return key
+    if not isinstance(f, types.FunctionType):
+        return None
+    values = _value_key(tuple(c.cell_contents for c in f.func_closure or ()) +
+                        tuple(f.func_defaults or ()))
+    if values is None:
+        return None
+    return '%s%s' % (callable_key(f), values)
+
+
+class ChoiceCache(object):
+
+    """
+    Cache of choice lists shared between requests.
+
+    Choices are keyed by tables, query and orderby of a select, and are
+    invalidated by DAL callbacks after insert, update or delete.  web2py
+    defines tables anew in every request, so callbacks must be added to
+    tables of each request, whether or not it reads choices.  Call `watch()`
+    in the model file right after the tables are defined::
+
+        choice_cache.watch(db.color, db.size)
+
+    Tables touched by a cached select are watched too, but writes of requests
+    which don't render choices would be missed without the call above.
+
+    Invalidation is done in the process which writes.  With a per-process
+    cache model, like `MemoryCache` or ``cache.ram``, other processes keep
+    their choices until `time_expire`.  With several worker processes use a
+    model shared by them, e.g. ``cache.disk``, or a short `time_expire`.
+
+    Args:
+        * cache_model: web2py cache model, e.g. ``cache.ram`` or
+                       ``cache.disk``; `MemoryCache` by default.
+        * time_expire: seconds cached choices are valid for.
+    """
+
+    prefix = 'wtforms_web2py/choices/'
+
+    def __init__(self, cache_model=None, time_expire=300):
+        if cache_model is None:
+            cache_model = MemoryCache()
+        self.cache_model = cache_model
+        self.time_expire = time_expire
+
+    def __call__(self, dbset, orderby, loader, variant=''):
+        """
+        Returns cached result of ``loader()`` for select of `dbset`.
+
+        `variant` distinguishes different loaders of the same select.
+        """
+        db = dbset.db
+        tablenames = sorted(db._adapter.tables(dbset.query))
+        for tablename in tablenames:
+            self.watch(db[tablename])
+        digest = hashlib.md5(repr((
+            str(db._uri), str(dbset.query), str(orderby), variant))).hexdigest()
+        key = '%s%s/%s' % (self.prefix, ','.join(tablenames), digest)
+        return self.cache_model(key, loader, self.time_expire)
+
+    def watch(self, *tables):
+        """
+        Hooks write callbacks of `tables` to invalidate their cached choices.
+        """
+        for table in tables:
+            invalidator = _Invalidator(self, table._tablename)
+            for callbacks in (table._after_insert, table._after_update,
+                              table._after_delete):
+                if invalidator not in callbacks:
+                    callbacks.append(invalidator)
+
+    def invalidate(self, tablename=None):
+        """
+        Drops cached choices of `tablename`, or all cached choices.
+        """
+        if tablename is None:
+            regex = '^' + re.escape(self.prefix)
+        else:
+            regex = '^%s([^/]*,)?%s(,[^/]*)?/' % (
+                re.escape(self.prefix), re.escape(tablename))
+        self.cache_model.clear(regex)
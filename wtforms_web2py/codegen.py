@@ -0,0 +1,229 @@
+"""
+Ahead-of-time compilation of `model_form()` classes into a Python module.
+
+Build step, e.g. run on deploy::
+
+    source = compile_forms([db.customer, db.order])
+    open("applications/app/modules/compiled_forms.py", "w").write(source)
+
+and in the app::
+
+    import compiled_forms
+    CustomerForm = load_form(compiled_forms, db.customer)
+
+So worker processes import ready form classes instead of converting tables
+on first use.  Tables changed after compilation are detected by a digest of
+their definition, and their forms are made by `model_form()` until the
+module is regenerated.
+"""
+import datetime
+import decimal
+import hashlib
+import re
+import sys
+import types
+
+from wtforms import validators as v
+from gluon.dal import DAL, Expression, Field, Query, Set, Table
+from gluon.languages import lazyT
+
+from .dal import ModelConverter, model_fields, model_form
+from .form import Form
+
+
+_Pattern = type(re.compile(''))
+
+
+class Uncompilable(Exception):
+    pass
+
+
+def restore(cls, state):
+    """
+    Recreates an instance of `cls` with attributes `state`, without calling
+    its constructor.  Used by generated modules.
+    """
+    obj = cls.__new__(cls)
+    obj.__dict__.update(state)
+    return obj
+
+
+def _import_path(obj):
+    """
+    Returns ``module.name`` by which `obj` (class or function) is importable.
+    """
+    module, name = getattr(obj, '__module__', None), obj.__name__
+    if getattr(sys.modules.get(module), name, None) is not obj:
+        # E.g. defined in a web2py model.
+        raise Uncompilable("%r isn't importable." % (obj,))
+    return '%s.%s' % (module, name)
+
+
+class _SourceWriter(object):
+
+    def __init__(self):
+        self.modules = set(['datetime', 'decimal', 're'])
+
+    def path(self, obj):
+        path = _import_path(obj)
+        self.modules.add(path.rsplit('.', 1)[0])
+        return path
+
+    def source(self, value):
+        """
+        Returns expression recreating `value`.
+        """
+        if value is None or isinstance(value, (bool, int, long, float)):
+            return repr(value)
+        if isinstance(value, unicode):
+            return repr(unicode(value))
+        if isinstance(value, str):
+            return repr(value)
+        if isinstance(value, (datetime.date, datetime.time, datetime.timedelta)):
+            return 'datetime.' + repr(value)
+        if isinstance(value, decimal.Decimal):
+            return 'decimal.' + repr(value)
+        if isinstance(value, list):
+            return '[%s]' % ', '.join(self.source(x) for x in value)
+        if isinstance(value, tuple):
+            return '(%s)' % ''.join(self.source(x) + ', ' for x in value)
+        if isinstance(value, dict):
+            return '{%s}' % ', '.join(
+                '%s: %s' % (self.source(k), self.source(x))
+                for k, x in sorted(value.iteritems()))
+        if isinstance(value, (DAL, Table, Set, Query, Expression, lazyT)):
+            raise Uncompilable("%r can't be compiled." % (value,))
+        if isinstance(value, (type, types.ClassType, types.FunctionType,
+                              types.BuiltinFunctionType)):
+            return self.path(value)
+        if isinstance(value, types.MethodType) and value.im_self is not None:
+            return 'getattr(%s, %r)' % (self.source(value.im_self),
+                                        value.__name__)
+        if isinstance(value, _Pattern):
+            return 're.compile(%r, %d)' % (value.pattern, value.flags)
+        if type(value) is v.Optional:
+            # Its state is a lambda.
+            return '%s(strip_whitespace=%r)' % (
+                self.path(v.Optional), value.string_check(u' ') == u'')
+        if hasattr(value, '__dict__'):
+            return 'restore(%s, %s)' % (self.path(type(value)),
+                                        self.source(vars(value)))
+        raise Uncompilable("%r can't be compiled." % (value,))
+
+
+def _stable(value, _seen=frozenset()):
+    """
+    Returns representation of `value` which is equal in any process while
+    `value` is equal, unlike `dal._fingerprint()`.
+    """
+    if value is None or isinstance(value, (bool, int, long, float, basestring,
+                                           datetime.date, datetime.time,
+                                           decimal.Decimal)):
+        return value
+    if id(value) in _seen:
+        return ('cycle',)
+    _seen = _seen | frozenset([id(value)])
+    if isinstance(value, (list, tuple)):
+        return tuple(_stable(x, _seen) for x in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _stable(x, _seen))
+                            for k, x in value.iteritems()))
+    if isinstance(value, DAL):
+        return ('DAL',)
+    if isinstance(value, Table):
+        return ('Table', value._tablename)
+    if isinstance(value, Field):
+        return ('Field', value.tablename, value.name)
+    if isinstance(value, (Set, Query, Expression)):
+        return (type(value).__name__, str(getattr(value, 'query', value)))
+    if isinstance(value, lazyT):
+        return ('lazyT', value.m, _stable(value.s, _seen))
+    if isinstance(value, (type, types.ClassType, types.FunctionType,
+                          types.BuiltinFunctionType)):
+        return (getattr(value, '__module__', None), value.__name__)
+    if isinstance(value, types.MethodType):
+        return (value.__name__, _stable(value.im_self, _seen))
+    if isinstance(value, _Pattern):
+        return ('re', value.pattern, value.flags)
+    if hasattr(value, '__dict__'):
+        return (_stable(type(value)), _stable(vars(value), _seen))
+    return repr(value)
+
+
+def schema_digest(table):
+    """
+    Returns digest of `table` definition relevant for form conversion, equal
+    between processes.
+    """
+    definition = (table._tablename, tuple(
+        (field.name, field.type, field.length, field.required, field.unique,
+         field.notnull, _stable(field.label), _stable(field.comment),
+         _stable(field.default), _stable(field.requires))
+        for field in (table[name] for name in table.fields)))
+    return hashlib.md5(repr(definition)).hexdigest()
+
+
+def _class_source(writer, table, base_class, converter):
+    fields = sorted(model_fields(table, converter=converter).iteritems(),
+                    key=lambda item: item[1].creation_counter)
+    lines = ['class %s(%s):' % (table._tablename.title() + "Form",
+                                writer.path(base_class)),
+             '    _tablename = %r' % table._tablename]
+    for name, unbound in fields:
+        arguments = [writer.source(x) for x in unbound.args]
+        # Underscored arguments, like options of QuerySelectField, are made
+        # from the others when the field is created.
+        arguments.extend('%s=%s' % (k, writer.source(x))
+                         for k, x in sorted(unbound.kwargs.iteritems())
+                         if not k.startswith('_'))
+        lines.append('    %s = %s(%s)' % (
+            name, writer.path(unbound.field_class), ', '.join(arguments)))
+    return '\n'.join(lines)
+
+
+def compile_forms(tables, base_class=Form, converter=None):
+    """
+    Returns source of a module with form classes of `tables`, equal to ones
+    made by ``model_form(table, base_class, converter=converter)``.
+
+    Module has ``FORMS`` and ``FINGERPRINTS`` dicts by table name.  Tables
+    with fields which can't be compiled, e.g. with choices of IS_IN_DB of a
+    restricted set, are left out, so `load_form()` makes their forms
+    dynamically.
+    """
+    converter = converter or ModelConverter()
+    writer = _SourceWriter()
+    classes, digests, skipped = [], [], []
+    for table in tables:
+        try:
+            classes.append((table._tablename,
+                            _class_source(writer, table, base_class, converter)))
+        except Uncompilable, e:
+            skipped.append('# %s is not compiled: %s' % (table._tablename, e))
+            continue
+        digests.append((table._tablename, schema_digest(table)))
+    lines = ['# Generated by wtforms_web2py.codegen.compile_forms(), do not edit.']
+    lines.extend('import %s' % module for module in sorted(writer.modules))
+    lines.append('from wtforms_web2py.codegen import restore')
+    lines.append('')
+    lines.extend(skipped)
+    for tablename, source in classes:
+        lines.extend(['', source, ''])
+    lines.append('')
+    lines.append('FINGERPRINTS = %s' % writer.source(dict(digests)))
+    lines.append('FORMS = {%s}' % ', '.join(
+        '%r: %sForm' % (tablename, tablename.title())
+        for tablename, source in classes))
+    return '\n'.join(lines) + '\n'
+
+
+def load_form(module, table, **kwargs):
+    """
+    Returns form class of `table` from `module` generated by
+    `compile_forms()`, or ``model_form(table, **kwargs)`` if it's missing or
+    `table` has changed since.
+    """
+    tablename = table._tablename
+    if module.FINGERPRINTS.get(tablename) == schema_digest(table):
+        return module.FORMS[tablename]
+    return model_form(table, **kwargs)
@@ -1,11 +1,37 @@
 from wtforms_web2py.utils import force_unicode
 
 class ForgivingUnicode(unicode):
+    # UTF-8 encoded value, made once by `__str__`.
+    __slots__ = ('_utf8',)
+
     def __new__(cls, val):
-        unicoded_val = force_unicode(val, 'utf-8')
-        return super(ForgivingUnicode, cls).__new__(cls, unicoded_val)
+        val_type = type(val)
+        if val_type is cls:
+            # Immutable, so it may be shared.
+            return val
+        if val_type is str:
+            try:
+                self = unicode.__new__(cls, val.decode('utf-8'))
+            except UnicodeDecodeError:
+                pass
+            else:
+                # Encoded form is already known.
+                self._utf8 = val
+                return self
+        if not isinstance(val, unicode):
+            val = force_unicode(val, 'utf-8')
+        self = unicode.__new__(cls, val)
+        self._utf8 = None
+        return self
+
     def __str__(self):
-        return self.encode('utf-8')
+        if self._utf8 is None:
+            self._utf8 = self.encode('utf-8')
+        return self._utf8
+
+    def __reduce__(self):
+        # Slots aren't pickled without this; the encoded form is remade.
+        return (ForgivingUnicode, (unicode(self),))
 
 text_type = ForgivingUnicode
 string_types = basestring,
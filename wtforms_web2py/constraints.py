@@ -0,0 +1,103 @@
+"""
+Client-side constraints derived from WTForms validators.
+
+Constraints of a field are a dict with any of the keys ``required``,
+``min``, ``max``, ``minlength``, ``maxlength``, ``format`` (``"email"``)
+and ``enum``.  `Field.xml()` renders them as HTML5 attributes, and
+`form.Form.json_schema()` as JSON Schema, so browsers and scripts may
+reject invalid input before it's posted.  Server-side validation is the
+same as without them.
+"""
+from wtforms import validators as v
+from wtforms.fields import IntegerField
+
+
+def _required(validator, constraints):
+    constraints["required"] = True
+
+
+def _number_range(validator, constraints):
+    if validator.min is not None:
+        constraints["min"] = validator.min
+    if validator.max is not None:
+        constraints["max"] = validator.max
+
+
+def _length(validator, constraints):
+    if validator.min > 0:
+        constraints["minlength"] = validator.min
+    if validator.max >= 0:
+        constraints["maxlength"] = validator.max
+
+
+def _email(validator, constraints):
+    constraints["format"] = "email"
+
+
+def _any_of(validator, constraints):
+    constraints["enum"] = list(validator.values)
+
+
+#: Validator class -> ``f(validator, constraints)`` updating constraints.
+#: Makers are looked up by MRO of validator's class.
+constraint_makers = {
+    v.DataRequired: _required,
+    v.InputRequired: _required,
+    v.NumberRange: _number_range,
+    v.Length: _length,
+    v.Email: _email,
+    v.AnyOf: _any_of,
+}
+
+
+def _lookup(cls):
+    for base in getattr(cls, '__mro__', (cls,)):
+        if base in constraint_makers:
+            return constraint_makers[base]
+
+
+def field_constraints(field, choices=True):
+    """
+    Returns constraints of bound `field`.  With `choices`, static choices of
+    select fields are given as ``enum``, but not ones loaded on demand.
+    """
+    constraints = {}
+    for validator in field.validators:
+        make = _lookup(type(validator))
+        if make is not None:
+            make(validator, constraints)
+    if (choices and "enum" not in constraints and
+            getattr(field, '_choices_loader', None) is None):
+        field_choices = getattr(field, 'choices', None)
+        if isinstance(field_choices, (list, tuple)):
+            constraints["enum"] = [value for value, label in field_choices]
+    return constraints
+
+
+def html_attributes(field):
+    """
+    Returns HTML5 attributes for rendering `field` with its constraints.
+    """
+    input_type = getattr(field.widget, 'input_type', None)
+    if input_type == 'hidden':
+        return {}
+    constraints = field_constraints(field, choices=False)
+    attributes = {}
+    if constraints.get("required"):
+        attributes["required"] = True
+    if input_type not in ('text', 'number'):
+        return attributes
+    if "min" in constraints or "max" in constraints:
+        # Browsers ignore min and max of text inputs.
+        attributes["type"] = "number"
+        if not isinstance(field, IntegerField):
+            attributes["step"] = "any"
+        for key in ("min", "max"):
+            if key in constraints:
+                attributes[key] = constraints[key]
+        return attributes
+    if input_type == 'text' and "maxlength" in constraints:
+        attributes["maxlength"] = constraints["maxlength"]
+    if input_type == 'text' and constraints.get("format") == "email":
+        attributes["type"] = "email"
+    return attributes
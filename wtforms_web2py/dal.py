@@ -1,8 +1,18 @@
+import hashlib
 import re
+import time
+import types
 from wtforms import validators as v, widgets, fields as wtforms_fields
+from wtforms.compat import text_type
+from wtforms.fields.core import UnboundField
 from gluon import (IS_IN_SET, IS_INT_IN_RANGE, IS_FLOAT_IN_RANGE, IS_LENGTH,
-                   IS_IN_DB, IS_NOT_EMPTY, IS_EMAIL)
+                   IS_IN_DB, IS_NOT_IN_DB, IS_NOT_EMPTY, IS_EMAIL, IS_EMPTY_OR)
+from gluon.dal import DAL, Expression, Field, Query, Set, Table
+from gluon.languages import lazyT
 from . import fields as web2py_wtforms_fields
+from .cache import MemoryCache, callable_key
+from . import stats as form_stats
+from .validators import Unique
 from form import Form
 
 
@@ -14,9 +24,12 @@ class _FieldsProxy(object):
     def __getattr__(self, name):
         for obj in self.objects:
             try:
-                return getattr(obj, name)
+                value = getattr(obj, name)
             except AttributeError:
                 continue
+            # Next lookups of `name` won't reach `__getattr__`.
+            setattr(self, name, value)
+            return value
         raise AttributeError("Can't find field %r." % name)
 
 
@@ -35,6 +48,16 @@ class FieldConverter(object):
     def can_convert(self, field):
         raise NotImplementedError
 
+    def can_convert_type(self, field_type):
+        """
+        Tells whether fields of `field_type` can be converted, or returns None
+        if it depends on something but the type, so `can_convert` should be
+        asked for each field.
+
+        Answers are cached per type by `ModelConverter`.
+        """
+        return None
+
     def convert(self, field, kwargs):
         '''
         Converts dal field to wtforms field.
@@ -56,34 +79,90 @@ class SimpleFieldConverter(FieldConverter):
     def can_convert(self, field):
         return self.dal_field_name == field.type
 
+    def can_convert_type(self, field_type):
+        return self.dal_field_name == field_type
+
     def convert(self, field, kwargs):
         return getattr(self.model_converter.fields, self.wtforms_field_name)(**kwargs)
 
 
+#: (regex, field type) -> groupdict of match or None.
+_type_matches = {}
+
+
 class RegexFieldConverter(FieldConverter):
 
     def can_convert(self, field):
-        return self.regex.match(field.type)
+        return self.parse(field.type) is not None
+
+    def can_convert_type(self, field_type):
+        return self.parse(field_type) is not None
+
+    def parse(self, field_type):
+        """
+        Returns groupdict of `regex` matched against `field_type`, or None.
+        Parsing is done once per type.
+        """
+        key = (self.regex, field_type)
+        try:
+            return _type_matches[key]
+        except KeyError:
+            m = self.regex.match(field_type)
+            groups = _type_matches[key] = m and m.groupdict()
+            return groups
 
 
 class ReferenceConverter(RegexFieldConverter):
     regex = re.compile(r"reference (?P<other_table_name>\w+)")
 
     def convert(self, field, kwargs):
-        from gluon import current
-        db = current.globalenv["db"]
-        m = self.regex.match(field.type)
-        other_table_name = m.groupdict()['other_table_name']
-        other_table = getattr(db, other_table_name)
+        other_table_name = self.parse(field.type)['other_table_name']
+        # The table is looked up when choices are needed, so the field
+        # doesn't hold a table of some request's DAL instance.
+        other_table = web2py_wtforms_fields.LazyTable(other_table_name)
+        if self.model_converter.choice_cache is not None:
+            kwargs.setdefault("cache", self.model_converter.choice_cache)
+        if self.model_converter.db is not None:
+            kwargs.setdefault("db", self.model_converter.db)
         return self.model_converter.fields.QuerySelectField(query=other_table, **kwargs)
 
 
+class ListReferenceConverter(RegexFieldConverter):
+    regex = re.compile(r"list:reference (?P<other_table_name>\w+)")
+
+    def convert(self, field, kwargs):
+        other_table_name = self.parse(field.type)['other_table_name']
+        other_table = web2py_wtforms_fields.LazyTable(other_table_name)
+        if self.model_converter.choice_cache is not None:
+            kwargs.setdefault("cache", self.model_converter.choice_cache)
+        if self.model_converter.db is not None:
+            kwargs.setdefault("db", self.model_converter.db)
+        return self.model_converter.fields.QuerySelectMultipleField(
+            query=other_table, **kwargs)
+
+
+class ListConverter(FieldConverter):
+    coerce = {
+        "list:string": text_type,
+        "list:integer": int,
+    }
+
+    def can_convert(self, field):
+        return field.type in self.coerce
+
+    def can_convert_type(self, field_type):
+        return field_type in self.coerce
+
+    def convert(self, field, kwargs):
+        kwargs.setdefault("coerce", self.coerce[field.type])
+        return self.model_converter.fields.ListField(**kwargs)
+
+
 class DecimalConverter(RegexFieldConverter):
     regex = re.compile(r"decimal\((?P<places>\d+),\s*(?P<rounding>\d+)\)")
 
     def convert(self, field, kwargs):
-        m = self.regex.match(field.type)
-        kwargs.update(m.groupdict())
+        kwargs.update(self.parse(field.type))
         return self.model_converter.fields.DecimalField(**kwargs)
 
 
@@ -92,6 +171,9 @@ class IdConverter(FieldConverter):
     def can_convert(self, field):
         return field.type == 'id'
 
+    def can_convert_type(self, field_type):
+        return field_type == 'id'
+
     def convert(self, field, kwargs):
         defaults = {
             "widget": widgets.HiddenInput()
@@ -101,6 +183,169 @@ class IdConverter(FieldConverter):
         return self.model_converter.fields.IntegerField(**defaults)
 
 
+class Translation(object):
+
+    """
+    Result of translation of web2py validators, filled by translators.
+    """
+
+    def __init__(self):
+        self.validators = []
+        self.choices = None
+        self.required = False
+        #: Web2py validators wrapped in IS_EMPTY_OR, so empty values pass.
+        self.empty_allowed = set()
+
+
+class ValidatorRegistry(object):
+
+    """
+    Mapping of web2py validator classes to translators.
+
+    Translator is called as ``translator(w2p_validator, translation)`` and
+    updates `Translation` with WTForms counterparts of `w2p_validator`.
+    Translators registered for a class are used for its subclasses too.
+    """
+
+    def __init__(self, translators=()):
+        self.translators = dict(translators)
+        self._lookups = {}
+
+    def register(self, w2p_class, translator):
+        self.translators[w2p_class] = translator
+        self._lookups.clear()
+
+    def copy(self):
+        return ValidatorRegistry(self.translators)
+
+    def lookup(self, w2p_class):
+        """
+        Returns translator of the nearest class in MRO of `w2p_class`, or None.
+        """
+        try:
+            return self._lookups[w2p_class]
+        except KeyError:
+            pass
+        translator = None
+        for cls in getattr(w2p_class, '__mro__', (w2p_class,)):
+            if cls in self.translators:
+                translator = self.translators[cls]
+                break
+        self._lookups[w2p_class] = translator
+        return translator
+
+
+def _translate_int_in_range(w2p_validator, translation):
+    translation.validators.append(v.NumberRange(
+        min=w2p_validator.minimum, max=w2p_validator.maximum - 1))
+
+
+def _translate_float_in_range(w2p_validator, translation):
+    translation.validators.append(v.NumberRange(
+        min=w2p_validator.minimum, max=w2p_validator.maximum,))
+
+
+def _translate_in_set(w2p_validator, translation):
+    # Static, so they're known without a form, e.g. in JSON Schema.
+    translation.choices = w2p_validator.options()
+
+
+def _selects_from_request_db(w2p_validator):
+    """
+    Returns whether IS_IN_DB `w2p_validator` selects from a whole table of
+    the database of current request, so it may be applied to the database of
+    another request by `_InDbChoices`.
+    """
+    from gluon import current
+    dbset = w2p_validator.dbset
+    return (dbset.query is None and
+            dbset.db is getattr(current, 'globalenv', {}).get('db'))
+
+
+def _in_db_state(w2p_validator):
+    # Selected rows are kept on the validator by `options()`.
+    return dict((name, value) for name, value in vars(w2p_validator).iteritems()
+                if name not in ('dbset', 'theset', 'labels'))
+
+
+class _InDbChoices(object):
+
+    """
+    Choices of IS_IN_DB, selected by a copy of the validator from the
+    database of current request, like `fields.LazyTable`.  Unlike the
+    validator, it may be kept in cached form classes.
+    """
+
+    def __init__(self, w2p_validator):
+        self.validator_class = type(w2p_validator)
+        self.state = _in_db_state(w2p_validator)
+
+    def __call__(self):
+        validator = self.validator_class.__new__(self.validator_class)
+        validator.__dict__.update(self.state)
+        validator.dbset = web2py_wtforms_fields.db_for(None, "choices")()
+        validator.theset = None
+        return validator.options()
+
+
+def _translate_in_db(w2p_validator, translation):
+    if _selects_from_request_db(w2p_validator):
+        translation.choices = _InDbChoices(w2p_validator)
+    else:
+        translation.choices = w2p_validator.options
+
+
+def _translate_length(w2p_validator, translation):
+    translation.validators.append(v.Length(
+        min=w2p_validator.minsize, max=w2p_validator.maxsize,
+        message=w2p_validator.error_message))
+
+
+def _translate_not_empty(w2p_validator, translation):
+    translation.required = True
+    translation.validators.append(v.DataRequired(
+        message=w2p_validator.error_message))
+
+
+def _translate_email(w2p_validator, translation):
+    translation.validators.append(v.Email(message=w2p_validator.error_message))
+
+
+def _translate_not_in_db(w2p_validator, translation):
+    """
+    Translates IS_NOT_IN_DB to `Unique`.  IS_NOT_IN_DB of a restricted set,
+    e.g. ``IS_NOT_IN_DB(db(db.person.active == True), ...)``, is left out:
+    its query can't be kept in a form class, so it's only checked by web2py.
+    """
+    if w2p_validator not in translation.empty_allowed:
+        # IS_NOT_IN_DB rejects empty values, Unique doesn't.
+        translation.required = True
+    if w2p_validator.dbset.query is not None:
+        return
+    tablename, fieldname = str(w2p_validator.field).split('.')
+    translation.validators.append(Unique(
+        tablename, fieldname, message=w2p_validator.error_message,
+        allowed=tuple(w2p_validator.allowed_override)))
+
+
+default_validator_registry = ValidatorRegistry({
+    IS_INT_IN_RANGE: _translate_int_in_range,
+    IS_FLOAT_IN_RANGE: _translate_float_in_range,
+    IS_IN_SET: _translate_in_set,
+    IS_IN_DB: _translate_in_db,
+    IS_LENGTH: _translate_length,
+    IS_NOT_EMPTY: _translate_not_empty,
+    IS_EMAIL: _translate_email,
+    IS_NOT_IN_DB: _translate_not_in_db,
+})
+
+
+def _converter_fingerprint(converter):
+    state = dict((name, value) for name, value in vars(converter).iteritems()
+                 if name != 'model_converter')
+    return (_fingerprint(type(converter)), _fingerprint(state))
+
+
 class ModelConverter(object):
 
     DEFAULT_SIMPLE_CONVERSIONS = {
@@ -112,12 +357,31 @@ class ModelConverter(object):
         "TextField": ["string"],
         "TextAreaField": ["text"],
     }
-    DEFAULT_CONVERTERS = [DecimalConverter, IdConverter, ReferenceConverter]
+    DEFAULT_CONVERTERS = [DecimalConverter, IdConverter, ReferenceConverter,
+                          ListReferenceConverter, ListConverter]
 
     #: ``getattr(fields, field_name)`` should return field class.
     fields = _FieldsProxy(web2py_wtforms_fields, wtforms_fields)
 
-    def __init__(self, converters=()):
+    def __init__(self, converters=(), choice_cache=None,
+                 validator_registry=None, db=None):
+        """
+        Args:
+            * converters: field converters tried before the default ones.
+            * choice_cache: `ChoiceCache` shared by reference fields.
+            * validator_registry: `ValidatorRegistry` translating web2py
+                                  validators, `default_validator_registry`
+                                  by default.
+            * db: `DAL` or resolver (e.g. `fields.ReplicaRouter`) given to
+                  reference fields, which use the request's database
+                  otherwise.
+        """
+        self.choice_cache = choice_cache
+        self.db = db
+        self.validator_registry = validator_registry or default_validator_registry
+        self._dispatch = {}
+        #: `converters` as they were when `_dispatch` was filled.
+        self._dispatch_converters = None
         self.converters = list(converters)
         for field_type, dal_fields in self.DEFAULT_SIMPLE_CONVERSIONS.iteritems():
             for name in dal_fields:
@@ -127,6 +391,19 @@ class ModelConverter(object):
         for cls in self.DEFAULT_CONVERTERS:
             self.converters.append(cls(self))
 
+    def cache_key(self):
+        """
+        Identifies conversion done by this converter for caching of form
+        classes.  Converters giving equal keys must convert equally.
+
+        Raises `_Uncacheable` if state of a field converter can't be
+        fingerprinted.
+        """
+        return (_fingerprint(type(self)),
+                tuple(_converter_fingerprint(c) for c in self.converters),
+                id(self.choice_cache), id(self.validator_registry),
+                _fingerprint(self.db))
+
     def convert(self, model, field, field_args=None):
         kwargs = {
             "label": field.label,
@@ -138,45 +415,88 @@ class ModelConverter(object):
         if field_args:
             kwargs.update(field_args)
 
-        validators, choices, required = self.convert_requires(field.requires)
+        validators, choices, required = self.convert_field_requires(field)
         kwargs["validators"].extend(validators)
-        if choices:
-            return self.fields.SelectField(choices=choices, **kwargs)
+        # Choices of ``list:reference`` (IS_IN_DB(..., multiple=True)) are
+        # checked by QuerySelectMultipleField with a single query instead.
+        if choices is not None and not field.type.startswith('list:reference'):
+            if field.type.startswith('list:'):
+                return self.fields.DeferredSelectMultipleField(
+                    choices=choices, **kwargs)
+            return self.fields.DeferredSelectField(choices=choices, **kwargs)
 
         if field.required or required:
             kwargs["validators"].append(v.Required())
         else:
             kwargs["validators"].append(v.Optional())
-            # TODO: field.unique vs IS_EMPTY_OR vs IS_NOT_EMPTY ?
+        if field.unique and not any(isinstance(x, Unique) for x in validators):
+            kwargs["validators"].append(
+                Unique(field.tablename, field.name, db=self.db))
 
-        for converter in self.converters:
-            if converter.can_convert(field):
+        for converter, static in self.converters_for(field.type):
+            if static or converter.can_convert(field):
                 return converter.convert(field, kwargs)
 
+    def converters_for(self, field_type):
+        """
+        Returns list of ``(converter, static)`` pairs to try for `field_type`
+        in order.  ``static`` converters are known to convert the type, others
+        have to be asked with `can_convert()`.
+
+        Answers are cached until `converters` change.
+        """
+        if self._dispatch_converters != self.converters:
+            self._dispatch.clear()
+            self._dispatch_converters = list(self.converters)
+        try:
+            return self._dispatch[field_type]
+        except KeyError:
+            pass
+        candidates = []
+        for converter in self.converters:
+            can_convert = getattr(converter, 'can_convert_type', None)
+            answer = can_convert(field_type) if can_convert else None
+            if answer is None:
+                candidates.append((converter, False))
+            elif answer:
+                candidates.append((converter, True))
+                break
+        self._dispatch[field_type] = candidates
+        return candidates
+
     def convert_requires(self, requires):
-        validators = []
-        choices = []
-        required = False
-        for w2p_validator in self.unwind_requires(requires):
-            if isinstance(w2p_validator, IS_INT_IN_RANGE):
-                validators.append(v.NumberRange(
-                    min=w2p_validator.minimum, max=w2p_validator.maximum - 1))
-            elif isinstance(w2p_validator, IS_FLOAT_IN_RANGE):
-                validators.append(v.NumberRange(
-                    min=w2p_validator.minimum, max=w2p_validator.maximum,))
-            elif isinstance(w2p_validator, (IS_IN_SET, IS_IN_DB)):
-                choices = w2p_validator.options()
-            elif isinstance(w2p_validator, IS_LENGTH):
-                validators.append(v.Length(
-                    min=w2p_validator.minsize, max=w2p_validator.maxsize,
-                    message=w2p_validator.error_message))
-            elif isinstance(w2p_validator, IS_NOT_EMPTY):
-                required = True
-                validators.append(v.DataRequired(
-                    message=w2p_validator.error_message))
-            elif isinstance(w2p_validator, IS_EMAIL):
-                validators.append(v.Email(message=w2p_validator.error_message))
-        return validators, choices, required
+        """
+        Translates web2py validators `requires` to WTForms validators.
+
+        Returns ``(validators, choices, required)``, where ``choices`` is None,
+        a list of IS_IN_SET choices, or a callable returning choices of
+        IS_IN_DB, so they aren't selected until a form needs them.
+        """
+        translation = Translation()
+        lookup = self.validator_registry.lookup
+        unwound = self.unwind_requires(requires)
+        for w2p_validator in unwound:
+            if isinstance(w2p_validator, IS_EMPTY_OR):
+                translation.empty_allowed.update(
+                    self.unwind_requires(w2p_validator.other))
+        for w2p_validator in unwound:
+            translator = lookup(type(w2p_validator))
+            if translator is not None:
+                translator(w2p_validator, translation)
+        return translation.validators, translation.choices, translation.required
+
+    def convert_field_requires(self, field):
+        """
+        Same as ``convert_requires(field.requires)``, but the result is kept
+        on `field` until its `requires` is reassigned.
+        """
+        cached = getattr(field, '_wtforms_requires', None)
+        if (cached is not None and cached[0] is field.requires and
+                cached[1] is self.validator_registry):
+            return cached[2]
+        result = self.convert_requires(field.requires)
+        field._wtforms_requires = (field.requires, self.validator_registry, result)
+        return result
 
     def unwind_requires(self, requires):
         """
@@ -186,13 +506,89 @@ class ModelConverter(object):
         * it can be either a validator instance or a list of them;
         * IS_EMPTY_OR and IS_LIST_OF validators contain another validator inside
           them.
+
+        `requires` itself is left intact.
         """
-        if not isinstance(requires, (list, tuple)):
-            requires = [requires]
-        for w2p_validator in requires[:]:
-            if hasattr(w2p_validator, "other"):
-                requires.extend(self.unwind_requires(w2p_validator.other))
-        return requires
+        if isinstance(requires, (list, tuple)):
+            unwound = list(requires)
+        else:
+            unwound = [requires]
+        i = 0
+        while i < len(unwound):
+            if hasattr(unwound[i], "other"):
+                other = unwound[i].other
+                if isinstance(other, (list, tuple)):
+                    unwound.extend(other)
+                else:
+                    unwound.append(other)
+            i += 1
+        return unwound
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+def _fingerprint(value, _seen=None):
+    """
+    Returns hashable representation of `value` which stays equal between
+    requests while `value` is equal.
+
+    Raises `_Uncacheable` for objects bound to a DAL instance, e.g. tables or
+    queries, as they can't be kept between requests.  IS_IN_DB of a whole
+    table of the request's database is converted by `_InDbChoices`, so its
+    database is left out.
+    """
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    if isinstance(value, (DAL, Table, Set, Query, Expression)):
+        raise _Uncacheable(value)
+    if isinstance(value, IS_IN_DB):
+        if not _selects_from_request_db(value):
+            raise _Uncacheable(value)
+        return ('IS_IN_DB', _fingerprint(type(value)),
+                _fingerprint(_in_db_state(value), _seen))
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return ('cycle',)
+    _seen = _seen | set([id(value)])
+    if isinstance(value, (list, tuple)):
+        return tuple(_fingerprint(x, _seen) for x in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _fingerprint(x, _seen))
+                            for k, x in value.iteritems()))
+    if isinstance(value, lazyT):
+        return ('lazyT', value.m, _fingerprint(value.s, _seen),
+                value.T and value.T.accepted_language)
+    if isinstance(value, (type, types.ClassType)):
+        # Classes defined in web2py models are redefined on every request, so
+        # they are compared by identity.
+        return ('class', value.__module__, value.__name__, id(value))
+    if isinstance(value, types.MethodType):
+        return (callable_key(value.im_func), _fingerprint(value.im_self, _seen))
+    if isinstance(value, types.FunctionType):
+        cells = [c.cell_contents for c in value.func_closure or ()]
+        return (callable_key(value), _fingerprint(cells, _seen),
+                _fingerprint(value.func_defaults, _seen))
+    if hasattr(value, '__dict__'):
+        return (_fingerprint(type(value)), _fingerprint(vars(value), _seen))
+    raise _Uncacheable(value)
+
+
+def table_fingerprint(table):
+    """
+    Returns fingerprint of `table` definition relevant for form conversion.
+    """
+    return (str(table._db._uri), table._tablename, tuple(
+        (field.name, field.type, field.length, field.required, field.unique,
+         field.notnull, _fingerprint(field.label), _fingerprint(field.comment),
+         _fingerprint(field.default), _fingerprint(field.requires))
+        for field in (table[name] for name in table.fields)))
+
+
+#: Form classes made by `model_form(..., cache=True)`.
+_form_classes = MemoryCache(maxsize=500)
 
 
 def model_fields(model, only=None, exclude=None, field_args=None, converter=None):
@@ -216,7 +612,7 @@ def model_fields(model, only=None, exclude=None, field_args=None, converter=None
 
 
 def model_form(table, base_class=Form, only=None, exclude=None, field_args=None,
-               converter=None):
+               converter=None, cache=False):
     """
     Make a WTForms form from DAL `table`.
 
@@ -227,6 +623,125 @@ def model_form(table, base_class=Form, only=None, exclude=None, field_args=None,
         * field_args: field_name -> kwargs dict mapping.
         * converter: instance of model converter.  Converter must have method
                      `convert(table, field, field_kwargs)`.
+        * cache: reuse form class made by previous call with the same table
+                 definition and arguments, e.g. in previous request.
+    """
+    def make_form():
+        name = table._tablename.title() + "Form"
+        t0 = time.time()
+        field_dict = model_fields(table, only, exclude, field_args, converter)
+        if form_stats.observers:
+            form_stats.emit(name, "convert", time.time() - t0)
+        # Table of `form.Form.save()`.
+        field_dict["_tablename"] = table._tablename
+        return type(name, (base_class,), field_dict)
+
+    if not cache or (converter and not hasattr(converter, 'cache_key')):
+        return make_form()
+    converter = converter or ModelConverter()
+    try:
+        key = repr((table_fingerprint(table), _fingerprint(base_class),
+                    _fingerprint(only), _fingerprint(exclude),
+                    _fingerprint(field_args), converter.cache_key()))
+    except _Uncacheable:
+        return make_form()
+    # Converter is cached along with the form to keep ids of classes in the
+    # key from being reused.
+    return _form_classes(hashlib.md5(key).hexdigest(),
+                         lambda: (make_form(), converter))[0]
+
+
+class _LazyUnboundField(object):
+
     """
-    field_dict = model_fields(table, only, exclude, field_args, converter)
-    return type(table._tablename.title() + "Form", (base_class,), field_dict)
+    Stands for an unbound field of `lazy_model_form()` until the field is
+    bound or its attributes are accessed, and converts DAL field then.
+
+    Form metaclass takes it for a field by `_formfield` attribute, which is
+    missing if DAL field can't be converted.
+    """
+
+    def __init__(self, db, tablename, name, field_args, converter):
+        UnboundField.creation_counter += 1
+        self.creation_counter = UnboundField.creation_counter
+        self._db = db
+        self._tablename = tablename
+        self._name = name
+        self._field_args = field_args
+        self._converter = converter
+        self._unbound = None
+        self._converted = False
+
+    def _resolve(self):
+        if not self._converted:
+            table = self._db[self._tablename]
+            if self._name in table.fields:
+                self._unbound = self._converter.convert(
+                    table, table[self._name], self._field_args)
+            self._converted = True
+            # Nothing of the request's DAL is needed any more.
+            self._db = None
+        return self._unbound
+
+    @property
+    def _formfield(self):
+        if self._resolve() is None:
+            raise AttributeError('_formfield')
+        return True
+
+    def bind(self, *args, **kwargs):
+        return self._resolve().bind(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        unbound = self._resolve()
+        if unbound is None:
+            raise AttributeError(name)
+        return getattr(unbound, name)
+
+
+def _defined_field_names(db, tablename):
+    """
+    Returns names of fields of `tablename`, without defining the table if
+    it's still lazy.
+    """
+    if tablename not in db._LAZY_TABLES:
+        return list(db[tablename].fields)
+    _, fields, args = db._LAZY_TABLES[tablename]
+    fields = list(fields) + list(db._common_fields)
+    names = []
+    if not args.get('primarykey') and not [
+            f for f in fields if isinstance(f, Field) and f.type == 'id']:
+        names.append('id')
+    for field in fields:
+        if isinstance(field, Table):
+            names.extend(f.name for f in field if f.type != 'id')
+        else:
+            names.append(field.name)
+    return [name for i, name in enumerate(names) if name not in names[:i]]
+
+
+def lazy_model_form(db, tablename, base_class=Form, only=None, exclude=None,
+                    field_args=None, converter=None):
+    """
+    Make a WTForms form from DAL table `tablename`, like `model_form()`, but
+    convert DAL fields on first use.
+
+    Making the form doesn't define tables of ``DAL(lazy_tables=True)``;
+    the table is defined when any field of the form is needed, and referenced
+    tables are defined when choices of reference fields are selected.
+    """
+    converter = converter or ModelConverter()
+    field_args = field_args or {}
+    names = _defined_field_names(db, tablename)
+    if only:
+        names = [name for name in names if name in only]
+    elif exclude:
+        names = [name for name in names if name not in exclude]
+    field_dict = dict(
+        (name, _LazyUnboundField(db, tablename, name, field_args.get(name),
+                                 converter))
+        for name in names)
+    field_dict["_tablename"] = tablename
+    return type(tablename.title() + "Form", (base_class,), field_dict)
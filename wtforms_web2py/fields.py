@@ -1,35 +1,314 @@
-from wtforms import (Form, SelectField, IntegerField, TextField, validators)
+import inspect
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from gluon.dal import DAL, Table
+from wtforms import (Form, Field, SelectField, SelectMultipleField,
+                     IntegerField, TextField, validators)
+from wtforms.compat import text_type
 from wtforms.fields.core import SelectFieldBase
 from wtforms.validators import Optional, ValidationError
-from wtforms.widgets import Select
 
+from .cache import loader_key
+from .stats import timed_query
+from .utils import force_unicode
+from .widgets import ListInput, StreamingSelect
 
-class QuerySelectField(SelectFieldBase):
-    widget = Select()
 
-    def __init__(self, label=None, validators=None, query=None, orderby=None,
-                 get_pk=None, get_label=None, allow_blank=False, blank_text='',
-                 **kwargs):
-        super(QuerySelectField, self).__init__(label, validators, **kwargs)
+def _get_id(obj):
+    return obj.id
+
+
+def _get_name(obj):
+    return obj.name
+
+
+class _ColumnGetter(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.cache_key = 'column:' + name
+
+    def __call__(self, row):
+        return row[self.name]
+
+
+class LazyTable(object):
+
+    """
+    Table given by name and looked up in the database of current request.
+
+    Unlike a `Table`, it may be kept between requests, e.g. in cached form
+    classes.
+    """
+
+    def __init__(self, tablename):
+        self.tablename = tablename
+
+    def __call__(self, db):
+        return db[self.tablename]
+
+    def __repr__(self):
+        return 'LazyTable(%r)' % self.tablename
+
+
+def _resolve_db(db):
+    return db if isinstance(db, DAL) else db()
+
+
+class ReplicaRouter(object):
+
+    """
+    Database resolver of `QuerySelectField` sending choice listing to a
+    read replica.
+
+    Validation goes to the replica too, unless `validate_on_primary` is
+    set, as the replica may lag behind; then submitted pks are looked up on
+    the primary whether or not choices were loaded from the replica.
+
+    `replica` and `primary` are `DAL` instances or callables returning them,
+    e.g. ``lambda: current.replica_db``, which can be kept in cached form
+    classes.  `primary` is the request's database by default.
+    """
+
+    def __init__(self, replica, primary=None, validate_on_primary=False):
+        self.replica = replica
+        self.primary = primary
+        self.validate_on_primary = validate_on_primary
+
+    def __call__(self, purpose):
+        if purpose == "validation" and self.validate_on_primary:
+            if self.primary is None:
+                from gluon import current
+                return current.globalenv["db"]
+            return _resolve_db(self.primary)
+        return _resolve_db(self.replica)
+
+
+def db_for(db, purpose):
+    """
+    Resolves `db` given to a field or validator: a `DAL`, a resolver called
+    with `purpose` (``"choices"`` or ``"validation"``), or None for the
+    database of current request.
+    """
+    if db is None:
+        from gluon import current
+        return current.globalenv["db"]
+    if isinstance(db, DAL):
+        return db
+    return db(purpose)
+
+
+def _column_name(column):
+    return column if isinstance(column, basestring) else column.name
+
+
+class DeferredSelectField(SelectField):
+
+    """
+    Select field which accepts callable `choices`.  It's called on first use
+    of choices, so forms which are never rendered or validated don't load
+    them.
+    """
+    widget = StreamingSelect()
+
+    def __init__(self, label=None, validators=None, **kwargs):
+        self._form = kwargs.get('_form')
+        super(DeferredSelectField, self).__init__(label, validators, **kwargs)
+
+    def _get_choices(self):
+        if self._choices_loader is not None:
+            with timed_query(self):
+                self._choices = list(self._choices_loader())
+            self._choices_loader = None
+        return self._choices
+
+    def _set_choices(self, choices):
+        if callable(choices):
+            self._choices_loader, self._choices = choices, None
+        else:
+            self._choices_loader, self._choices = None, choices
+
+    choices = property(_get_choices, _set_choices)
+
+
+class DeferredSelectMultipleField(DeferredSelectField, SelectMultipleField):
+
+    """
+    Multiple select of possibly callable `choices`, e.g. of ``list:string``
+    columns validated by ``IS_IN_SET(..., multiple=True)``.
+    """
+    widget = StreamingSelect(multiple=True)
+
+
+class ListField(Field):
+
+    """
+    List of values, each coerced by `coerce`, e.g. for ``list:string`` and
+    ``list:integer`` columns.  Empty items are skipped.
+    """
+    widget = ListInput()
+    json_type = "array"
+
+    def __init__(self, label=None, validators=None, coerce=text_type, **kwargs):
+        super(ListField, self).__init__(label, validators, **kwargs)
+        self.coerce = coerce
+
+    def process_data(self, value):
+        self.data = list(value) if value else []
+
+    def process_formdata(self, valuelist):
+        self.data = []
+        try:
+            data = [self.coerce(x) for x in valuelist if x not in ('', None)]
+        except ValueError:
+            raise ValueError(self.gettext('Not a valid value'))
+        self.data = data
+
+
+class _QuerySelectOptions(object):
+
+    """
+    Options of `QuerySelectField`, shared by all fields bound from one
+    unbound field, i.e. by instances of a form class.
+
+    Only these options are shared this way.  Label, flags and the rest of
+    field state of bound fields, of this and other field classes, are made
+    by WTForms per instance.
+    """
+    __slots__ = ('query', 'orderby', 'get_pk', 'get_label', 'allow_blank',
+                 'blank_text', 'cache', 'indexed_lookup', 'pk_field',
+                 'label_field', 'remote_url', 'db')
+
+    def __init__(self, query=None, orderby=None, get_pk=None, get_label=None,
+                 allow_blank=False, blank_text='', cache=None,
+                 indexed_lookup=False, pk_field=None, label_field=None,
+                 remote_url=None, db=None):
         self.query = query
         self.orderby = orderby
         self.allow_blank = allow_blank
         self.blank_text = blank_text
+        self.cache = cache
+        self.indexed_lookup = indexed_lookup or remote_url is not None
+        self.remote_url = remote_url
+        self.db = db
+        self.pk_field = pk_field
+        self.label_field = label_field
         if get_pk is None:
-            self.get_pk = lambda obj: obj.id
-        else:
-            self.get_pk = get_pk
+            if pk_field is None:
+                get_pk = _get_id
+            else:
+                get_pk = _ColumnGetter(_column_name(pk_field))
+        self.get_pk = get_pk
         if get_label is None:
-            self.get_label = lambda obj: obj.name
-        else:
-            self.get_label = get_label
+            if label_field is None:
+                get_label = _get_name
+            else:
+                get_label = _ColumnGetter(_column_name(label_field))
+        self.get_label = get_label
+
+    def replace(self, **changes):
+        options = _QuerySelectOptions.__new__(_QuerySelectOptions)
+        for name in self.__slots__:
+            setattr(options, name, changes.get(name, getattr(self, name)))
+        return options
+
+
+def _option(name, invalidates=False):
+    """
+    Property of `QuerySelectField` reading shared options.  Assignment
+    changes a copy of options private to the bound field.
+    """
+    def get(self):
+        return getattr(self._options, name)
+
+    def set(self, value):
+        self._options = self._options.replace(**{name: value})
+        if invalidates:
+            self.invalidate_choices()
+
+    return property(get, set)
+
+
+def _defined_by(cls, name):
+    for base in cls.__mro__:
+        if name in vars(base):
+            return base
+
+
+class QuerySelectField(SelectFieldBase):
+    widget = StreamingSelect()
+    #: JSON Schema type of `data`, see `form.Form.json_schema()`.
+    json_type = "integer"
+
+    #: Default and largest number of choices on a page of `remote_choices()`.
+    remote_page_size = 20
+    max_remote_page_size = 100
+
+    _choices = None
+    #: pk -> row or None, selected by `_lookup_row()` or `prefetch()`.
+    _lookups = None
+
+    def __new__(cls, *args, **kwargs):
+        if ('_form' not in kwargs or '_name' not in kwargs) and \
+                '_options' not in kwargs and \
+                _defined_by(cls, '__init__') is _defined_by(cls, '_make_options'):
+            # Unbound field: options are made once here instead of in each
+            # bound field.  Subclasses which change arguments in `__init__`
+            # make their options there, unless they override `_make_options()`
+            # the same way.
+            kwargs['_options'] = cls._make_options(*args, **kwargs)
+        return super(QuerySelectField, cls).__new__(cls, *args, **kwargs)
+
+    @classmethod
+    def _make_options(cls, *args, **kwargs):
+        """
+        Returns `_QuerySelectOptions` of constructor arguments.
+        """
+        arguments = inspect.getcallargs(QuerySelectField.__init__.im_func,
+                                        None, *args, **kwargs)
+        arguments.update(arguments.pop('kwargs', {}))
+        return _QuerySelectOptions(**dict(
+            (name, arguments[name])
+            for name in _QuerySelectOptions.__slots__ if name in arguments))
+
+    def __init__(self, label=None, validators=None, query=None, orderby=None,
+                 get_pk=None, get_label=None, allow_blank=False, blank_text='',
+                 cache=None, indexed_lookup=False, pk_field=None,
+                 label_field=None, remote_url=None, db=None, _options=None,
+                 **kwargs):
+        self._form = kwargs.get('_form')
+        super(QuerySelectField, self).__init__(label, validators, **kwargs)
+        if _options is None:
+            _options = _QuerySelectOptions(
+                query, orderby, get_pk, get_label, allow_blank, blank_text,
+                cache, indexed_lookup, pk_field, label_field, remote_url, db)
+        self._options = _options
+
+    query = _option('query', invalidates=True)
+    orderby = _option('orderby', invalidates=True)
+    get_pk = _option('get_pk')
+    get_label = _option('get_label')
+    allow_blank = _option('allow_blank')
+    blank_text = _option('blank_text')
+    cache = _option('cache')
+    indexed_lookup = _option('indexed_lookup')
+    pk_field = _option('pk_field')
+    label_field = _option('label_field')
+    remote_url = _option('remote_url')
+    db = _option('db')
+
+    def invalidate_choices(self):
+        """
+        Forgets loaded choices, so they are selected again on next access.
+        """
+        self._choices = None
+        self._lookups = None
 
     def _get_data(self):
         if self._formdata is not None:
-            for pk, row in self._get_object_list():
-                if pk == self._formdata:
-                    self._set_data(pk)
-                    break
+            if self._has_choice(self._formdata):
+                self._set_data(self._formdata)
         return self._data
 
     def _set_data(self, data):
@@ -38,17 +317,249 @@ class QuerySelectField(SelectFieldBase):
 
     data = property(_get_data, _set_data)
 
-    def _get_object_list(self):
+    def _get_db(self, purpose="choices"):
+        """
+        Returns database for `purpose`, ``"choices"`` (listing) or
+        ``"validation"``.
+
+        `db` given to the field is either a `DAL` or a resolver called with
+        `purpose`, e.g. `ReplicaRouter`.  By default it's the database of
+        current request.
+        """
+        return db_for(self.db, purpose)
+
+    def _get_object_list(self, db=None):
         get_pk = self.get_pk
-        from gluon import current
-        db = current.globalenv["db"]
-        return [(get_pk(row), row) for row in db(self.query).select(orderby=self.orderby)]
+        if db is None:
+            db = self._get_db()
+        dbset = db(self._resolve_query(db))
+        columns = self._get_columns(db)
+        with timed_query(self):
+            if columns is None:
+                rows = dbset.select(orderby=self.orderby)
+            else:
+                # `cacheable` rows are parsed without per-row helpers like
+                # `update_record` and lazy sets of referencing records.
+                rows = dbset.select(*columns, orderby=self.orderby,
+                                    cacheable=True)
+        return [(get_pk(row), row) for row in rows]
+
+    def _load_choices(self, db=None):
+        get_label = self.get_label
+        return [(pk, get_label(row)) for pk, row in self._get_object_list(db)]
+
+    def _get_choices(self):
+        """
+        Returns ordered ``pk -> label`` mapping of available choices.
+
+        Choices are selected once and kept until `invalidate_choices()` is
+        called, so rendering and validating the field share one query.  With
+        `cache` (a `ChoiceCache`) they are also shared between requests.
+        """
+        if self._choices is None:
+            variant = self._cache_variant() if self.cache is not None else None
+            if variant is None:
+                # Without a reliable key, choices can't be shared.
+                choices = self._load_choices()
+            else:
+                choices = self.cache(
+                    self._get_dbset(), self.orderby,
+                    self._load_choices, variant)
+            self._choices = OrderedDict(choices)
+        return self._choices
+
+    def _resolve_query(self, db):
+        if isinstance(self.query, LazyTable):
+            return self.query(db)
+        return self.query
+
+    def _get_dbset(self):
+        db = self._get_db()
+        return db(self._resolve_query(db))
+
+    def _find_table(self, db):
+        query = self._resolve_query(db)
+        if isinstance(query, Table):
+            return query
+        tablenames = db._adapter.tables(db(query).query)
+        if len(tablenames) == 1:
+            return db[tablenames[0]]
+
+    def _get_table(self, db):
+        table = self._find_table(db)
+        if table is None:
+            raise ValueError("Can't find table of query %r." % (self.query,))
+        return table
+
+    def _get_column(self, db, column):
+        if isinstance(column, basestring):
+            return self._get_table(db)[column]
+        return column
+
+    def _get_columns(self, db):
+        """
+        Returns ``(pk_column, label_column)`` to select instead of whole rows.
+
+        Columns are either given as `pk_field` and `label_field`, or inferred
+        from the table of the query for default `get_pk` and `get_label`
+        (``id`` and ``name`` columns).  Returns None when columns are unknown.
+        """
+        pk_field, label_field = self.pk_field, self.label_field
+        if pk_field is None or label_field is None:
+            table = self._find_table(db)
+            if table is None:
+                return None
+            if pk_field is None and self.get_pk is _get_id:
+                pk_field = table._id
+            if (label_field is None and self.get_label is _get_name and
+                    'name' in table.fields):
+                label_field = table.name
+            if pk_field is None or label_field is None:
+                return None
+        return (self._get_column(db, pk_field),
+                self._get_column(db, label_field))
+
+    def _get_pk_column(self, db):
+        if self.pk_field is None:
+            return self._get_table(db)._id
+        return self._get_column(db, self.pk_field)
+
+    def _lookup_row(self, pk):
+        """
+        Returns row of choice `pk` selected by primary key, or None.
+        """
+        if self._lookups is None:
+            self._lookups = {}
+        if pk not in self._lookups:
+            db = self._get_db("validation")
+            pk_column = self._get_pk_column(db)
+            columns = self._get_columns(db) or ()
+            with timed_query(self):
+                rows = db(self._resolve_query(db))(pk_column == pk).select(
+                    *columns, limitby=(0, 1), cacheable=True)
+            self._lookups[pk] = rows.first()
+        return self._lookups[pk]
+
+    def prefetch(self, pks):
+        """
+        Selects rows of choices `pks` with a single ``belongs()`` query, so
+        they are then checked without querying, e.g. for many records
+        validated by `batch.validate_records()`.
+        """
+        if self._lookups is None:
+            self._lookups = {}
+        pks = [pk for pk in set(pks) if pk not in self._lookups]
+        if not pks:
+            return
+        db = self._get_db("validation")
+        pk_column = self._get_pk_column(db)
+        columns = self._get_columns(db) or ()
+        with timed_query(self):
+            rows = db(self._resolve_query(db))(pk_column.belongs(pks)).select(
+                *columns, cacheable=True)
+        lookups = dict.fromkeys(pks)
+        get_pk = self.get_pk
+        for row in rows:
+            lookups[get_pk(row)] = row
+        self._lookups.update(lookups)
+
+    def _validates_elsewhere(self):
+        """
+        Tells whether choices are validated by another database than they
+        are listed from, e.g. by `ReplicaRouter` with `validate_on_primary`.
+        """
+        return (self.db is not None and not isinstance(self.db, DAL) and
+                self._get_db("validation") is not self._get_db("choices"))
+
+    def _has_choice(self, pk):
+        """
+        Checks that `pk` is one of the choices.
+
+        With `indexed_lookup` a single `pk` is checked by selecting at most one
+        row by primary key instead of selecting all the choices, unless they
+        are already loaded.  It's always checked so when the database for
+        validation isn't the one of choices.  This assumes that `get_pk`
+        returns `pk_field` (row's id by default).
+        """
+        if self._lookups and pk in self._lookups:
+            return self._lookups[pk] is not None
+        if self._validates_elsewhere():
+            return self._lookup_row(pk) is not None
+        if self._choices is not None or not self.indexed_lookup:
+            return pk in self._get_choices()
+        return self._lookup_row(pk) is not None
+
+    def remote_choices(self, term=None, after=None, limit=None):
+        """
+        Returns a page of choices for `remote_url` endpoint, e.g.::
+
+            v = request.vars
+            return response.json(
+                form.field.remote_choices(v.term, v.after, v.limit))
+
+        Choices are ordered by pk and contain `term` in label.  The page
+        follows pk `after`, so no rows are skipped by the database.  Result
+        is ``{"choices": [[pk, label], ...], "after": pk}``, where ``after``
+        is the value for the next page, or None on the last page.
+
+        Arguments may be request variables: empty ones are ignored, and
+        `limit` is at most `max_remote_page_size`, `remote_page_size` by
+        default.  Non-integer `after` or `limit` raise ValueError.
+        """
+        db = self._get_db()
+        columns = self._get_columns(db)
+        if columns is None:
+            raise ValueError("Remote choices need pk_field and label_field.")
+        pk_column, label_column = columns
+        if limit in (None, ''):
+            limit = self.remote_page_size
+        limit = max(1, min(int(limit), self.max_remote_page_size))
+        dbset = db(self._resolve_query(db))
+        if term:
+            dbset = dbset(label_column.contains(term))
+        if after not in (None, ''):
+            dbset = dbset(pk_column > int(after))
+        with timed_query(self):
+            rows = dbset.select(pk_column, label_column, orderby=pk_column,
+                                limitby=(0, limit + 1), cacheable=True)
+        get_pk, get_label = self.get_pk, self.get_label
+        choices = [[get_pk(row), force_unicode(get_label(row))]
+                   for i, row in enumerate(rows) if i < limit]
+        return {"choices": choices,
+                "after": choices[-1][0] if len(rows) > limit else None}
+
+    def _cache_variant(self):
+        """
+        Returns key of `get_pk` and `get_label` in `cache`, or None if they
+        can't be keyed.
+        """
+        keys = loader_key(self.get_pk), loader_key(self.get_label)
+        if None in keys:
+            return None
+        return '%s/%s' % keys
+
+    def __call__(self, **kwargs):
+        if self.remote_url is not None:
+            kwargs.setdefault('data-remote-url', self.remote_url)
+        return super(QuerySelectField, self).__call__(**kwargs)
 
     def iter_choices(self):
+        if self.remote_url is not None:
+            # Only the selected choice is rendered, others are loaded by
+            # client from `remote_url`.
+            data = self.data
+            if self.allow_blank:
+                yield ("__None", self.blank_text, data is None)
+            row = self._lookup_row(data) if data is not None else None
+            if row is not None:
+                yield (data, self.get_label(row), True)
+            return
+        choices = self._get_choices()
+        data = self.data
         if self.allow_blank:
-            yield ("__None", self.blank_text, self.data is None)
-        for pk, row in self._get_object_list():
-            yield (pk, self.get_label(row), pk == self.data)
+            yield ("__None", self.blank_text, data is None)
+        for pk, label in choices.iteritems():
+            yield (pk, label, pk == data)
 
     def process_formdata(self, valuelist):
         if valuelist:
@@ -60,8 +571,118 @@ class QuerySelectField(SelectFieldBase):
 
     def pre_validate(self, form):
         if not self.allow_blank or self.data is not None:
-            for pk, obj in self._get_object_list():
-                if self.data == pk:
-                    break
-            else:
+            if self.data is None or not self._has_choice(self.data):
                 raise ValidationError(self.gettext('Not a valid choice'))
+
+
+class QuerySelectMultipleField(QuerySelectField):
+
+    """
+    Like `QuerySelectField`, but `data` is a list of pks, e.g. of a
+    ``list:reference`` column.
+
+    With `indexed_lookup` (the default) any number of submitted pks are
+    checked with a single ``belongs()`` query, unless the choices are
+    already loaded.
+    """
+    widget = StreamingSelect(multiple=True)
+    json_type = "array"
+
+    def __init__(self, label=None, validators=None, indexed_lookup=True,
+                 **kwargs):
+        kwargs.pop('allow_blank', None)
+        super(QuerySelectMultipleField, self).__init__(
+            label, validators, indexed_lookup=indexed_lookup, **kwargs)
+
+    @classmethod
+    def _make_options(cls, label=None, validators=None, indexed_lookup=True,
+                      **kwargs):
+        kwargs.pop('allow_blank', None)
+        return super(QuerySelectMultipleField, cls)._make_options(
+            label, validators, indexed_lookup=indexed_lookup, **kwargs)
+
+    def _get_data(self):
+        if self._formdata is not None:
+            if self._has_choices(self._formdata):
+                self._set_data(self._formdata)
+        return self._data
+
+    def _set_data(self, data):
+        self._data = data
+        self._formdata = None
+
+    data = property(_get_data, _set_data)
+
+    def _has_choices(self, pks):
+        if ((self._choices is None and self.indexed_lookup) or
+                self._validates_elsewhere()):
+            self.prefetch(pks)
+        return all(self._has_choice(pk) for pk in pks)
+
+    def iter_choices(self):
+        if self.remote_url is not None:
+            data = self.data or ()
+            self.prefetch(data)
+            for pk in data:
+                row = self._lookups[pk]
+                if row is not None:
+                    yield (pk, self.get_label(row), True)
+            return
+        choices = self._get_choices()
+        data = set(self.data or ())
+        for pk, label in choices.iteritems():
+            yield (pk, label, pk in data)
+
+    def process_data(self, value):
+        self.data = list(value) if value else []
+
+    def process_formdata(self, valuelist):
+        self._data = None
+        self._formdata = [int(x) for x in valuelist if x != "__None"]
+
+    def pre_validate(self, form):
+        if self.data is None:
+            raise ValidationError(self.gettext('Not a valid choice'))
+
+
+def _load_choices_with(db_factory):
+    def load(field):
+        db = db_factory()
+        try:
+            return field._load_choices(db)
+        finally:
+            db._adapter.close('rollback')
+    return load
+
+
+def prefetch_choices(form, db_factory=None, workers=4):
+    """
+    Loads choices of all `QuerySelectField`s of `form` up front.
+
+    With `db_factory`, a callable returning a new `DAL` instance with the same
+    tables (ideally with ``pool_size``, so connections are reused), choices
+    are selected concurrently by at most `workers` threads, each query on its
+    own connection.  So the form waits for the slowest query instead of all
+    of them.  Fields with `cache` or their own `db` (e.g. `ReplicaRouter`),
+    and all fields without `db_factory`, are loaded one by one, like on
+    first use.
+    """
+    fields = [field for field in form
+              if isinstance(field, QuerySelectField) and
+              field._choices is None and field.remote_url is None]
+    concurrent = []
+    for field in fields:
+        if db_factory is not None and field.cache is None and field.db is None:
+            concurrent.append(field)
+        else:
+            field._get_choices()
+    if not concurrent:
+        return
+    pool = ThreadPool(min(workers, len(concurrent)))
+    try:
+        results = pool.map(_load_choices_with(db_factory), concurrent)
+    finally:
+        pool.close()
+        pool.join()
+    for field, choices in zip(concurrent, results):
+        field._choices = OrderedDict(choices)
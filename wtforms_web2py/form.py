@@ -1,16 +1,370 @@
+import json
+import time
+from cgi import escape
+
 from wtforms import Form as WTForm
+from wtforms import fields as wtforms_fields
+from wtforms.form import BaseForm
+
+from . import stats as form_stats
+from .constraints import field_constraints
+from .utils import force_unicode
+
+
+#: Field class -> JSON Schema type of its data, looked up by MRO.
+_json_types = {
+    wtforms_fields.IntegerField: "integer",
+    wtforms_fields.FloatField: "number",
+    wtforms_fields.DecimalField: "number",
+    wtforms_fields.BooleanField: "boolean",
+    wtforms_fields.SelectMultipleField: "array",
+}
+
+#: Constraint -> JSON Schema keyword.
+_json_keywords = {
+    "min": "minimum",
+    "max": "maximum",
+    "minlength": "minLength",
+    "maxlength": "maxLength",
+    "format": "format",
+    "enum": "enum",
+}
+
+
+def _same(data, object_data):
+    """
+    Tells whether field `data` equals `object_data` of the edited record.
+    Empty string and NULL are the same for forms.
+    """
+    if data in (None, '') and object_data in (None, ''):
+        return True
+    if isinstance(data, basestring) and isinstance(object_data, basestring):
+        return force_unicode(data) == force_unicode(object_data)
+    return data == object_data
+
+
+def _json_type(field):
+    for cls in type(field).__mro__:
+        if cls in _json_types:
+            return _json_types[cls]
+    return "string"
+
+
+class _WidgetSlot(object):
+
+    def __init__(self, field_name):
+        self.field_name = field_name
+
+    def __call__(self, form):
+        field = form._fields[self.field_name]
+        html = field.xml()
+        if field.errors:
+            html += ''.join(
+                '<div class="error">%s</div>' %
+                escape(force_unicode(error)).encode('utf-8')
+                for error in field.errors)
+        return html
+
+
+class _LabelSlot(_WidgetSlot):
+
+    def __call__(self, form):
+        return form._fields[self.field_name].label().xml()
+
+
+def _layout(form):
+    return tuple((name, field.id,
+                  getattr(field.widget, "input_type", None) == "hidden")
+                 for name, field in form._fields.iteritems())
+
+
+class _RenderTemplate(list):
+
+    """
+    Compiled markup of a form, see `Form._compile_render_template()`, with
+    the layout of fields and labels it has as static markup.
+    """
+
+    def __init__(self, parts, layout, static_labels):
+        super(_RenderTemplate, self).__init__(parts)
+        #: (field name, field id, hidden) of each field.
+        self.layout = layout
+        #: (field name, label's field id, label text).
+        self.static_labels = static_labels
+
+    def matches(self, form):
+        """
+        Tells whether fields of `form`, their ids, whether they're hidden and
+        static labels are the same as in the template, i.e. they weren't
+        changed on the instance, e.g. by ``del form.field``.
+        """
+        if _layout(form) != self.layout:
+            return False
+        fields = form._fields
+        for name, field_id, text in self.static_labels:
+            label = fields[name].label
+            if label.text != text or label.field_id != field_id:
+                return False
+        return True
 
 
 class Form(WTForm):
 
+    #: `FormStats` of the instance while `stats.observers` are registered.
+    stats = None
+    #: Name of the table of forms made by `dal.model_form()`.
+    _tablename = None
+    _obj = None
+
     @property
     def fields(self):
         for field in self:
-            if field.widget.input_type != "hidden":
+            if getattr(field.widget, "input_type", None) != "hidden":
                 yield field
 
     @property
     def hidden_fields(self):
         for field in self:
-            if field.widget.input_type == "hidden":
+            if getattr(field.widget, "input_type", None) == "hidden":
                 yield field
+
+    def _get_stats(self):
+        if self.stats is None:
+            self.stats = form_stats.FormStats(type(self).__name__)
+        return self.stats
+
+    def process(self, formdata=None, obj=None, **kwargs):
+        # Record being edited, see `save()`.
+        self._obj = obj
+        if not form_stats.observers:
+            return super(Form, self).process(formdata, obj, **kwargs)
+        stats = self._get_stats()
+        t0 = time.time()
+        super(Form, self).process(formdata, obj, **kwargs)
+        stats.record("process", time.time() - t0)
+
+    def validate(self):
+        if not form_stats.observers:
+            return super(Form, self).validate()
+        # Same as `wtforms.Form.validate()`, but timing each field.
+        stats = self._get_stats()
+        t0 = time.time()
+        self._errors = None
+        success = True
+        for name, field in self._fields.iteritems():
+            inline = getattr(self.__class__, 'validate_%s' % name, None)
+            extra = (inline,) if inline is not None else ()
+            field_t0 = time.time()
+            if not field.validate(self, extra):
+                success = False
+            stats.record("validate", time.time() - field_t0, name)
+        stats.record("validate", time.time() - t0)
+        return success
+
+    def xml(self):
+        """
+        Renders the form fields for web2py template: hidden fields first, then
+        label and widget of every other field, like web2py's "divs" formstyle.
+
+        Markup which doesn't change between instances is made once per form
+        class and prefix, and kept encoded.
+        """
+        template = self._get_render_template()
+        if not form_stats.observers:
+            return ''.join([part if isinstance(part, str) else part(self)
+                            for part in template])
+        stats = self._get_stats()
+        t0 = time.time()
+        html = []
+        for part in template:
+            if isinstance(part, str):
+                html.append(part)
+            else:
+                part_t0 = time.time()
+                html.append(part(self))
+                stats.record("render", time.time() - part_t0, part.field_name)
+        stats.record("render", time.time() - t0)
+        return ''.join(html)
+
+    @classmethod
+    def _get_table(cls, db):
+        if cls._tablename is None:
+            raise ValueError("Form %s has no table, it should be made by "
+                             "model_form()." % cls.__name__)
+        if db is None:
+            from gluon import current
+            db = current.globalenv["db"]
+        return db[cls._tablename]
+
+    def _column_data(self, table):
+        return dict((name, field.data) for name, field in self._fields.iteritems()
+                    if name in table.fields and name != table._id.name)
+
+    def changed_data(self, db=None):
+        """
+        Returns ``column -> data`` of fields whose data differs from data of
+        the record given as `obj` to the form.
+        """
+        if self._obj is None:
+            raise ValueError("Changes are known only for a record given to "
+                             "the form as obj.")
+        table = self._get_table(db)
+        return dict((name, data)
+                    for name, data in self._column_data(table).iteritems()
+                    if not _same(data, self._fields[name].object_data))
+
+    def save(self, db=None):
+        """
+        Inserts a new record of the form's table, or updates the edited one,
+        given as `obj` to the form, and returns its id.
+
+        Only columns whose data changed since the record was given to the
+        form are updated, and nothing is written if none changed.  Posted
+        ``id`` must be the id of the record, if any.  The form should be
+        validated before.
+        """
+        table = self._get_table(db)
+        id_field = self._fields.get(table._id.name)
+        posted_id = id_field.data if id_field is not None else None
+        if self._obj is None:
+            if posted_id:
+                raise ValueError("Record %s should be given to the form as "
+                                 "obj to update it." % posted_id)
+            return table.insert(**self._column_data(table))
+        record_id = self._obj[table._id.name]
+        if posted_id and posted_id != record_id:
+            raise ValueError("Posted id %s isn't id of the edited record %s."
+                             % (posted_id, record_id))
+        changes = self.changed_data(table._db)
+        if changes:
+            table._db(table._id == record_id).update(**changes)
+        return record_id
+
+    @classmethod
+    def bulk_insert(cls, forms, db=None, batch_size=500):
+        """
+        Inserts records of validated `forms` with ``bulk_insert()`` of
+        `batch_size` records, and returns their ids.
+        """
+        table = cls._get_table(db)
+        ids, batch = [], []
+        for form in forms:
+            batch.append(form._column_data(table))
+            if len(batch) == batch_size:
+                ids.extend(table.bulk_insert(batch))
+                batch = []
+        if batch:
+            ids.extend(table.bulk_insert(batch))
+        return ids
+
+    @classmethod
+    def validate_field(cls, name, formdata, obj=None, prefix='',
+                       context=('id',)):
+        """
+        Validates field `name` alone, e.g. for validation as user types, and
+        returns the bound field with its `errors` and `data`.
+
+        Other fields aren't bound, processed or validated, so only the field's
+        own queries are made.  Fields named in `context` are bound and
+        processed too, but not validated, e.g. ``id`` of the edited record
+        for `validators.Unique`.  Validators comparing with other fields,
+        like `EqualTo`, can't be checked.
+        """
+        unbound = getattr(cls, name, None)
+        if name.startswith('_') or not hasattr(unbound, '_formfield'):
+            raise KeyError(name)
+        fields = [(name, unbound)]
+        for context_name in context:
+            if context_name != name and not context_name.startswith('_'):
+                context_field = getattr(cls, context_name, None)
+                if hasattr(context_field, '_formfield'):
+                    fields.append((context_name, context_field))
+        # Instance without `__init__()`, which would bind all the fields.
+        form = cls.__new__(cls)
+        BaseForm.__init__(form, fields, prefix)
+        for field_name, field in form._fields.iteritems():
+            setattr(form, field_name, field)
+        form.process(formdata, obj)
+        field = form._fields[name]
+        inline = getattr(cls, 'validate_%s' % name, None)
+        field.validate(form, (inline,) if inline is not None else ())
+        return field
+
+    @classmethod
+    def json_schema(cls):
+        """
+        Returns JSON Schema of data posted by the form, with constraints of
+        its fields (see `constraints`).  It's made once per form class.
+        """
+        schema = cls.__dict__.get('_json_schema')
+        if schema is None:
+            unbound = sorted(
+                ((name, getattr(cls, name)) for name in dir(cls)
+                 if not name.startswith('_') and
+                 hasattr(getattr(cls, name), '_formfield')),
+                key=lambda item: item[1].creation_counter)
+            properties, required = {}, []
+            for name, unbound_field in unbound:
+                field = unbound_field.bind(form=None, name=name)
+                constraints = field_constraints(field)
+                if constraints.pop("required", False):
+                    required.append(name)
+                prop = {"type": getattr(field, 'json_type', None) or
+                                _json_type(field)}
+                for key, value in constraints.iteritems():
+                    prop[_json_keywords[key]] = value
+                properties[name] = prop
+            schema = {"type": "object", "properties": properties}
+            if required:
+                schema["required"] = required
+            # Underscored, so the form metaclass ignores it.
+            cls._json_schema = schema = json.dumps(schema, sort_keys=True)
+        return schema
+
+    def _get_render_template(self):
+        cls = type(self)
+        templates = cls.__dict__.get('_render_templates')
+        if templates is None:
+            templates = {}
+            # Underscored, so the form metaclass ignores it.
+            cls._render_templates = templates
+        template = templates.get(self._prefix)
+        if template is None:
+            template = templates[self._prefix] = self._compile_render_template()
+        elif not template.matches(self):
+            # Fields changed on this instance are rendered by its own
+            # template.
+            return self._compile_render_template()
+        return template
+
+    def _compile_render_template(self):
+        """
+        Returns `_RenderTemplate`, a list of static UTF-8 fragments and
+        slots, which are callables rendering the changing parts of an
+        instance.
+        """
+        template = []
+        static_labels = []
+        for field in self.hidden_fields:
+            template.append(_WidgetSlot(field.short_name))
+        for field in self.fields:
+            template.append('<div id="%s__row"><div class="w2p_fl">' %
+                            escape(force_unicode(field.id), quote=True).encode('utf-8'))
+            if isinstance(field.label.text, basestring):
+                template.append(field.label().xml())
+                static_labels.append((field.short_name, field.label.field_id,
+                                      field.label.text))
+            else:
+                # E.g. web2py's lazyT translated for each request.
+                template.append(_LabelSlot(field.short_name))
+            template.append('</div><div class="w2p_fw">')
+            template.append(_WidgetSlot(field.short_name))
+            template.append('</div></div>')
+        # Join neighbouring static fragments.
+        compiled = []
+        for part in template:
+            if isinstance(part, str) and compiled and isinstance(compiled[-1], str):
+                compiled[-1] += part
+            else:
+                compiled.append(part)
+        return _RenderTemplate(compiled, _layout(self), static_labels)
@@ -0,0 +1,92 @@
+"""
+Instrumentation of forms.
+
+While there are observers, every `wtforms_web2py.form.Form` instance gets
+`FormStats` in its `stats` attribute, and each measurement is also sent to
+observers as an event dict::
+
+    {"form": "UserForm", "phase": "validate", "field": "name",
+     "seconds": 0.0001, "queries": 0}
+
+``field`` is None for measurements of the whole form.  Phases are
+``convert`` (`model_form()`), ``process``, ``validate``, ``render`` and
+``query`` (a select issued by a field).  Without observers nothing is
+measured.
+"""
+import time
+
+
+#: Callables receiving event dicts.
+observers = []
+
+
+def add_observer(observer):
+    observers.append(observer)
+
+
+def remove_observer(observer):
+    observers.remove(observer)
+
+
+def emit(form, phase, seconds, field=None, queries=0):
+    event = {"form": form, "phase": phase, "field": field,
+             "seconds": seconds, "queries": queries}
+    for observer in observers:
+        observer(event)
+
+
+class FormStats(object):
+
+    """
+    Timings and query counts of one form instance.
+
+    Attributes:
+        * timings: phase -> seconds spent by the whole form;
+        * field_timings: (field name, phase) -> seconds;
+        * queries: field name -> number of selects issued by the field.
+    """
+
+    def __init__(self, form_name):
+        self.form_name = form_name
+        self.timings = {}
+        self.field_timings = {}
+        self.queries = {}
+
+    @property
+    def total_queries(self):
+        return sum(self.queries.itervalues())
+
+    def record(self, phase, seconds, field=None):
+        if field is None:
+            self.timings[phase] = self.timings.get(phase, 0) + seconds
+        else:
+            key = (field, phase)
+            self.field_timings[key] = self.field_timings.get(key, 0) + seconds
+        emit(self.form_name, phase, seconds, field)
+
+    def record_query(self, field, seconds):
+        self.queries[field] = self.queries.get(field, 0) + 1
+        key = (field, "query")
+        self.field_timings[key] = self.field_timings.get(key, 0) + seconds
+        emit(self.form_name, "query", seconds, field, queries=1)
+
+
+class timed_query(object):
+
+    """
+    Context manager recording a select issued by bound `field` of a form
+    with stats.  Does nothing without observers.
+    """
+
+    def __init__(self, field):
+        self.stats = observers and getattr(
+            getattr(field, '_form', None), 'stats', None)
+        self.field_name = field.short_name
+
+    def __enter__(self):
+        if self.stats:
+            self.t0 = time.time()
+
+    def __exit__(self, *exc_info):
+        if self.stats:
+            self.stats.record_query(self.field_name, time.time() - self.t0)
@@ -1,19 +1,38 @@
 # encoding: utf-8
+import cPickle
+import imp
+import json
+import pickle
+import shutil
 import sys
+import tempfile
+import threading
 import unittest
+from decimal import Decimal
 from mock import Mock
 
 from wtforms import Form, validators as v
 from wtforms.compat import text_type
 from wtforms.fields import TextField
-from wtforms.widgets import TextInput
+from wtforms.fields import SelectField
+from wtforms.widgets import HiddenInput, Select, TextInput
 
 import gluon
-from gluon import (DAL, Field, IS_EMPTY_OR, IS_IN_SET, IS_INT_IN_RANGE,
-                   IS_IN_DB, IS_LIST_OF, IS_NOT_EMPTY, IS_EMAIL)
+from gluon import (DAL, Field, IS_EMPTY_OR, IS_FLOAT_IN_RANGE, IS_IN_SET,
+                   IS_INT_IN_RANGE, IS_IN_DB, IS_LENGTH, IS_LIST_OF,
+                   IS_NOT_EMPTY, IS_NOT_IN_DB, IS_EMAIL)
 
-from fields import QuerySelectField
-from dal import model_form, ModelConverter
+from batch import validate_records
+from cache import ChoiceCache, MemoryCache
+from codegen import compile_forms, load_form
+from form import Form as Web2pyForm
+import stats
+from fields import (ListField, QuerySelectField, QuerySelectMultipleField,
+                    LazyTable, ReplicaRouter, prefetch_choices)
+from validators import Unique
+from widgets import StreamingSelect
+from dal import (model_form, lazy_model_form, ModelConverter, FieldConverter,
+                 SimpleFieldConverter, default_validator_registry)
 
 
 class DummyPostData(dict):
@@ -78,6 +97,28 @@ class BaseDALTest(unittest.TestCase):
             self.db.__class__.__call__ = self._old_dal_call
 
 
+class SQLiteDALTest(BaseDALTest):
+
+    """
+    Runs against real in-memory SQLite database, counting issued queries in
+    `self.queries`.
+    """
+
+    def setUp(self):
+        db = self.db = DAL("sqlite:memory")
+        self._saved_current = gluon.current
+        gluon.current = Mock(globalenv={"db": db})
+        self.queries = []
+        execute = db._adapter.execute
+        def counting_execute(*args, **kwargs):
+            self.queries.append(args[0])
+            return execute(*args, **kwargs)
+        db._adapter.execute = counting_execute
+
+    def selects(self):
+        return [q for q in self.queries if q.startswith("SELECT")]
+
+
 class QuerySelectFieldTest(BaseDALTest):
 
     def test_field_outputs_whatever_it_should(self):
@@ -103,6 +144,603 @@ class QuerySelectFieldTest(BaseDALTest):
         form.qsf()
         self._db_call(query).select.assert_called_with(orderby=orderby)
 
+    def test_choices_are_selected_once(self):
+        query = object()
+        objects = (_make_row(id=1, name="First"),
+                   _make_row(id=2, name="Second"))
+        self.mock_db_query(query=query, response=objects)
+
+        class F(Form):
+            qsf = QuerySelectField(query=query, widget=LazySelect())
+        form = F(DummyPostData(qsf=["2"]))
+        self.assertTrue(form.validate())
+        self.assertEqual(form.qsf.data, 2)
+        self.assertEqual([(1, u'First', False), (2, u'Second', True)],
+                         form.qsf())
+        self.assertEqual(self._db_call(query).select.call_count, 1)
+
+    def test_invalid_choice(self):
+        query = object()
+        self.mock_db_query(query=query,
+                           response=[_make_row(id=1, name="First")])
+
+        class F(Form):
+            qsf = QuerySelectField(query=query)
+        form = F(DummyPostData(qsf=["3"]))
+        self.assertFalse(form.validate())
+        self.assertEqual(form.qsf.data, None)
+
+    def test_changing_query_invalidates_choices(self):
+        query = object()
+        self.mock_db_query(query=query,
+                           response=[_make_row(id=1, name="First")])
+
+        class F(Form):
+            qsf = QuerySelectField(query=object(), widget=LazySelect())
+        form = F()
+        form.qsf()
+        form.qsf.query = query
+        self.assertEqual([(1, u'First', False)], form.qsf())
+        self.assertEqual(self._db_call(query).select.call_count, 2)
+
+
+class SharedOptionsTest(unittest.TestCase):
+
+    class F(Form):
+        qsf = QuerySelectField(u"Label", [], "query", allow_blank=True)
+        multiple = QuerySelectMultipleField(query="other")
+
+    def test_options_are_shared(self):
+        first, second = self.F(), self.F()
+        self.assertTrue(first.qsf._options is second.qsf._options)
+        self.assertEqual((first.qsf.query, first.qsf.allow_blank),
+                         ("query", True))
+        self.assertFalse("query" in vars(first.qsf))
+        self.assertTrue(first.multiple.indexed_lookup)
+
+    def test_multiple_ignores_allow_blank(self):
+        class F(Form):
+            multiple = QuerySelectMultipleField(query="other", allow_blank=True)
+        first, second = F(), F()
+        self.assertTrue(first.multiple._options is second.multiple._options)
+        self.assertFalse(first.multiple.allow_blank)
+
+    def test_subclass_changing_arguments(self):
+        class CategoryField(QuerySelectField):
+            def __init__(self, label=None, validators=None, **kwargs):
+                kwargs['query'] = "categories"
+                super(CategoryField, self).__init__(label, validators, **kwargs)
+        class F(Form):
+            category = CategoryField(allow_blank=True)
+        form = F()
+        self.assertEqual(form.category.query, "categories")
+        self.assertTrue(form.category.allow_blank)
+
+    def test_assignment_is_private(self):
+        first, second = self.F(), self.F()
+        first.qsf._choices = {}
+        first.qsf.query = "changed"
+        self.assertEqual(first.qsf.query, "changed")
+        self.assertTrue(first.qsf._choices is None)
+        self.assertEqual(second.qsf.query, "query")
+        self.assertEqual(self.F().qsf.query, "query")
+
+
+class ChoiceCacheTest(SQLiteDALTest):
+
+    def setUp(self):
+        super(ChoiceCacheTest, self).setUp()
+        self.table = self.db.define_table("color", Field("name"))
+        self.table.insert(name="red")
+        self.table.insert(name="green")
+        self.cache = ChoiceCache()
+
+        class F(Form):
+            qsf = QuerySelectField(query=self.table, cache=self.cache,
+                                   widget=LazySelect())
+        self.F = F
+
+    def test_choices_are_shared_between_forms(self):
+        self.assertEqual([(1, u'red', False), (2, u'green', False)],
+                         self.F().qsf())
+        self.assertEqual([(1, u'red', False), (2, u'green', False)],
+                         self.F().qsf())
+        self.assertEqual(len(self.selects()), 1)
+
+    def test_writes_invalidate_choices(self):
+        self.F().qsf()
+        self.table.insert(name="blue")
+        self.assertEqual(len(self.F().qsf()), 3)
+        self.db(self.table.id == 1).update(name="yellow")
+        self.assertEqual(self.F().qsf()[0], (1, u'yellow', False))
+        self.db(self.table.id == 1).delete()
+        self.assertEqual(len(self.F().qsf()), 2)
+        self.assertEqual(len(self.selects()), 4)
+
+    def test_watch_is_idempotent(self):
+        self.F().qsf()
+        self.F().qsf()
+        self.assertEqual(len(self.table._after_insert), 1)
+
+    def test_watched_tables_of_later_requests_invalidate(self):
+        self.F().qsf()
+        # Next request defines the table anew and writes without reading
+        # choices.
+        table = self.db.define_table("color", Field("name"), redefine=True,
+                                     migrate=False)
+        self.cache.watch(table)
+        table.insert(name="blue")
+        self.assertEqual(len(self.F().qsf()), 3)
+        self.assertEqual(len(table._after_insert), 1)
+
+    def test_closures_are_keyed_by_their_values(self):
+        def by(column):
+            return lambda row: row[column]
+        class F(Form):
+            a = QuerySelectField(query=self.table, cache=self.cache,
+                                 get_label=by("name"), widget=LazySelect())
+            b = QuerySelectField(query=self.table, cache=self.cache,
+                                 get_label=by("id"), widget=LazySelect())
+        form = F()
+        self.assertEqual(form.a()[0], (1, u'red', False))
+        self.assertEqual(form.b()[0], (1, u'1', False))
+        self.assertEqual(F().b()[0], (1, u'1', False))
+        self.assertEqual(len(self.selects()), 2)
+
+    def test_unkeyable_loaders_are_not_cached(self):
+        names = {1: "one", 2: "two"}
+        class F(Form):
+            qsf = QuerySelectField(query=self.table, cache=self.cache,
+                                   get_label=lambda row: names[row.id],
+                                   widget=LazySelect())
+        self.assertEqual(F().qsf()[0], (1, "one", False))
+        self.assertEqual(F().qsf()[0], (1, "one", False))
+        self.assertEqual(len(self.selects()), 2)
+
+
+class IndexedLookupTest(SQLiteDALTest):
+
+    def setUp(self):
+        super(IndexedLookupTest, self).setUp()
+        self.table = self.db.define_table("customer", Field("name"))
+        for name in ("Vasya", "Petya", "Kolya"):
+            self.table.insert(name=name)
+        self.queries[:] = []
+
+        class F(Form):
+            qsf = QuerySelectField(query=self.table, indexed_lookup=True,
+                                   widget=LazySelect())
+        self.F = F
+
+    def test_valid_pk(self):
+        form = self.F(DummyPostData(qsf=["2"]))
+        self.assertTrue(form.validate())
+        self.assertEqual(form.qsf.data, 2)
+        self.assertEqual(len(self.selects()), 1)
+        self.assertTrue("LIMIT 1" in self.selects()[0])
+        self.assertTrue("customer.id = 2" in self.selects()[0])
+
+    def test_invalid_pk(self):
+        form = self.F(DummyPostData(qsf=["99"]))
+        self.assertFalse(form.validate())
+        self.assertEqual(len(self.selects()), 1)
+
+    def test_query_restricts_lookup(self):
+        class F(Form):
+            qsf = QuerySelectField(query=self.table.name != "Petya",
+                                   indexed_lookup=True)
+        self.assertFalse(F(DummyPostData(qsf=["2"])).validate())
+        self.assertTrue(F(DummyPostData(qsf=["3"])).validate())
+
+    def test_loaded_choices_are_used(self):
+        form = self.F(DummyPostData(qsf=["2"]))
+        form.qsf()
+        self.assertTrue(form.validate())
+        self.assertEqual(len(self.selects()), 1)
+
+
+class QuerySelectMultipleFieldTest(SQLiteDALTest):
+
+    def setUp(self):
+        super(QuerySelectMultipleFieldTest, self).setUp()
+        self.table = self.db.define_table("tag", Field("name"))
+        for i in range(30):
+            self.table.insert(name="tag%d" % i)
+        self.queries[:] = []
+
+        class F(Form):
+            tags = QuerySelectMultipleField(query=self.table)
+        self.F = F
+
+    def test_many_pks_checked_with_one_query(self):
+        pks = [str(i) for i in range(1, 25)]
+        form = self.F(DummyPostData(tags=pks))
+        self.assertTrue(form.validate())
+        self.assertEqual(form.tags.data, range(1, 25))
+        self.assertEqual(len(self.selects()), 1)
+        self.assertTrue(" IN (" in self.selects()[0])
+
+    def test_invalid_pk(self):
+        form = self.F(DummyPostData(tags=["1", "99"]))
+        self.assertFalse(form.validate())
+        self.assertEqual(len(self.selects()), 1)
+
+    def test_render_selects_choices_once(self):
+        form = self.F(DummyPostData(tags=["2", "3"]))
+        html = form.tags()
+        self.assertTrue('multiple' in html)
+        self.assertEqual(html.count("selected"), 2)
+        self.assertTrue(form.validate())
+        self.assertEqual(len(self.selects()), 1)
+
+
+class PrefetchChoicesTest(BaseDALTest):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.threads = []
+        db = self.make_db()
+        for name in ("Anna", "Ivan"):
+            db.customer.insert(name=name)
+            db.product.insert(name=name + "'s")
+        db.commit()
+        self.db = db
+        self._saved_current = gluon.current
+        gluon.current = Mock(globalenv={"db": db})
+
+        class F(Form):
+            customer = QuerySelectField(query=db.customer)
+            product = QuerySelectField(query=db.product.id > 1)
+            cached = QuerySelectField(query=db.customer, cache=ChoiceCache())
+        self.F = F
+
+    def tearDown(self):
+        super(PrefetchChoicesTest, self).tearDown()
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def make_db(self):
+        self.threads.append(threading.current_thread())
+        db = DAL("sqlite://test.db", folder=self.folder)
+        db.define_table("customer", Field("name"))
+        db.define_table("product", Field("name"))
+        return db
+
+    def test_choices_are_loaded_concurrently(self):
+        form = self.F()
+        self.threads = []
+        prefetch_choices(form, self.make_db)
+        # The cached field is loaded by the request's database.
+        self.assertEqual(len(self.threads), 2)
+        self.assertFalse(threading.current_thread() in self.threads)
+        self.assertEqual(form.customer._choices.items(),
+                         [(1, "Anna"), (2, "Ivan")])
+        self.assertEqual(form.product._choices.items(), [(2, "Ivan's")])
+        self.assertEqual(form.cached._choices.items(),
+                         [(1, "Anna"), (2, "Ivan")])
+
+    def test_sequential_without_factory(self):
+        form = self.F()
+        self.threads = []
+        prefetch_choices(form)
+        self.assertEqual(self.threads, [])
+        self.assertEqual(form.product._choices.items(), [(2, "Ivan's")])
+
+
+class ReplicaRoutingTest(SQLiteDALTest):
+
+    def setUp(self):
+        super(ReplicaRoutingTest, self).setUp()
+        self.replica = DAL("sqlite:memory")
+        for db in (self.db, self.replica):
+            db.define_table("customer", Field("name"))
+            db.customer.insert(name="Anna")
+            db.customer.insert(name="Ivan")
+        # The replica lags behind.
+        self.db.customer.insert(name="Olga")
+
+    def make_form(self, db, **kwargs):
+        class F(Form):
+            customer = QuerySelectField(query=LazyTable("customer"), db=db,
+                                        indexed_lookup=True, **kwargs)
+        return F
+
+    def test_explicit_db(self):
+        form = self.make_form(self.replica)()
+        self.assertEqual(form.customer().count("<option"), 2)
+        self.assertEqual(self.selects(), [])
+
+    def test_prefetch_keeps_replica(self):
+        form = self.make_form(ReplicaRouter(lambda: self.replica))()
+        prefetch_choices(form, lambda: self.fail("db_factory was used"))
+        self.assertEqual(len(form.customer._choices), 2)
+        self.assertEqual(self.selects(), [])
+
+    def test_choices_from_replica(self):
+        F = self.make_form(ReplicaRouter(lambda: self.replica))
+        self.assertEqual(F().customer().count("<option"), 2)
+        self.assertFalse(F(DummyPostData(customer=["3"])).validate())
+        self.assertEqual(self.selects(), [])
+
+    def test_validation_on_primary(self):
+        router = ReplicaRouter(self.replica, validate_on_primary=True)
+        form = self.make_form(router)(DummyPostData(customer=["3"]))
+        self.assertTrue(form.validate())
+        self.assertEqual(len(self.selects()), 1)
+
+    def test_validation_on_primary_through_converter(self):
+        self.db.define_table("purchase", Field("customer", "reference customer"))
+        router = ReplicaRouter(self.replica, validate_on_primary=True)
+        F = model_form(self.db.purchase, converter=ModelConverter(db=router))
+        form = F(DummyPostData(customer=["3"]))
+        self.assertTrue(form.validate())
+        # Choices listed from the replica don't reject the row either.
+        form = F(DummyPostData(customer=["3"]))
+        self.assertEqual(form.customer().count("<option"), 2)
+        self.assertTrue(form.validate())
+        self.assertFalse(F(DummyPostData(customer=["4"])).validate())
+
+    def test_converter_passes_db(self):
+        self.db.define_table("purchase", Field("customer", "reference customer"))
+        converter = ModelConverter(db=self.replica)
+        form = model_form(self.db.purchase, converter=converter)()
+        self.assertTrue(form.customer.db is self.replica)
+
+
+class RemoteChoicesTest(SQLiteDALTest):
+
+    def setUp(self):
+        super(RemoteChoicesTest, self).setUp()
+        self.table = self.db.define_table("customer", Field("name"))
+        for name in ("Anna", "Boris", "Ivan", "Ivanna", "Vanya"):
+            self.table.insert(name=name)
+        self.queries[:] = []
+
+        class F(Form):
+            customer = QuerySelectField(query=self.table,
+                                        remote_url="/customers.json")
+        self.F = F
+
+    def test_renders_selected_choice_only(self):
+        form = self.F(customer=3)
+        self.assertEqual(form.customer(),
+            '<select data-remote-url="/customers.json" id="customer" '
+            'name="customer"><option selected value="3">Ivan</option></select>')
+        self.assertTrue("LIMIT 1" in self.selects()[0])
+
+    def test_validation(self):
+        self.assertTrue(self.F(DummyPostData(customer=["2"])).validate())
+        self.assertFalse(self.F(DummyPostData(customer=["9"])).validate())
+        self.assertEqual(len(self.selects()), 2)
+
+    def test_pages(self):
+        field = self.F().customer
+        page = field.remote_choices(limit=2)
+        self.assertEqual(page, {"choices": [[1, u"Anna"], [2, u"Boris"]],
+                                "after": 2})
+        page = field.remote_choices(after=page["after"], limit=2)
+        self.assertEqual(page, {"choices": [[3, u"Ivan"], [4, u"Ivanna"]],
+                                "after": 4})
+        page = field.remote_choices(after=page["after"], limit=2)
+        self.assertEqual(page, {"choices": [[5, u"Vanya"]], "after": None})
+        self.assertTrue("customer.id > 4" in self.selects()[-1])
+        self.assertTrue("LIMIT 3 OFFSET 0" in self.selects()[-1])
+
+    def test_search(self):
+        field = self.F().customer
+        self.assertEqual(field.remote_choices(term="anna", limit=2),
+                         {"choices": [[1, u"Anna"], [4, u"Ivanna"]],
+                          "after": None})
+
+    def test_request_vars(self):
+        field = self.F().customer
+        self.assertEqual(field.remote_choices("", "", ""),
+                         field.remote_choices())
+        self.assertEqual(len(field.remote_choices(after="2")["choices"]), 3)
+        field.max_remote_page_size = 2
+        page = field.remote_choices(limit="1000000")
+        self.assertEqual(len(page["choices"]), 2)
+        self.assertTrue("LIMIT 3 OFFSET 0" in self.selects()[-1])
+        self.assertRaises(ValueError, field.remote_choices, after="x")
+
+
+class ColumnProjectionTest(SQLiteDALTest):
+
+    def setUp(self):
+        super(ColumnProjectionTest, self).setUp()
+        self.table = self.db.define_table(
+            "article", Field("name"), Field("title"), Field("body", "text"))
+        self.table.insert(name="first", title="First", body="...")
+        self.table.insert(name="second", title="Second", body="...")
+        self.queries[:] = []
+
+    def test_infers_id_and_name(self):
+        class F(Form):
+            qsf = QuerySelectField(query=self.table, widget=LazySelect())
+        self.assertEqual([(1, u'first', False), (2, u'second', False)],
+                         F().qsf())
+        self.assertTrue(self.selects()[0].startswith(
+            "SELECT  article.id, article.name FROM"))
+
+    def test_label_field(self):
+        class F(Form):
+            qsf = QuerySelectField(query=self.table.id > 1,
+                                   label_field="title", widget=LazySelect())
+        self.assertEqual([(2, u'Second', False)], F().qsf())
+        self.assertTrue(self.selects()[0].startswith(
+            "SELECT  article.id, article.title FROM"))
+
+    def test_custom_get_label_selects_whole_rows(self):
+        class F(Form):
+            qsf = QuerySelectField(query=self.table,
+                                   get_label=lambda row: row.body,
+                                   widget=LazySelect())
+        self.assertEqual([(1, u'...', False), (2, u'...', False)], F().qsf())
+        self.assertTrue("article.body" in self.selects()[0])
+
+
+class BatchValidationTest(SQLiteDALTest):
+
+    def setUp(self):
+        super(BatchValidationTest, self).setUp()
+        self.db.define_table("customer", Field("name"))
+        for name in ("Anna", "Ivan", "Olga"):
+            self.db.customer.insert(name=name)
+        class F(Form):
+            name = TextField(validators=[v.Required()])
+            customer = QuerySelectField(query=self.db.customer)
+        self.F = F
+        del self.queries[:]
+
+    def test_errors_are_streamed_per_record(self):
+        records = [{"name": "a", "customer": "1"},
+                   {"name": "", "customer": "3"},
+                   {"name": "c", "customer": "7"},
+                   {"name": "d"}]
+        results = list(validate_records(self.F, records))
+        self.assertEqual([index for index, data, errors in results],
+                         [0, 1, 2, 3])
+        self.assertEqual(results[0][1], {"name": "a", "customer": 1})
+        self.assertEqual([sorted(errors) for index, data, errors in results],
+                         [[], ["name"], ["customer"], ["customer"]])
+
+    def test_one_query_per_chunk(self):
+        records = [{"name": "x", "customer": str(i % 4 + 1)}
+                   for i in range(10)]
+        results = list(validate_records(self.F, records, chunk_size=4))
+        self.assertEqual(len(results), 10)
+        self.assertEqual(len(self.selects()), 3)
+        self.assertTrue(all(" IN (" in q for q in self.selects()))
+        self.assertEqual([index for index, data, errors in results if errors],
+                         [3, 7])
+
+
+class UniqueTest(SQLiteDALTest):
+
+    def setUp(self):
+        super(UniqueTest, self).setUp()
+        self.table = self.db.define_table(
+            "account", Field("email", unique=True),
+            Field("login", requires=IS_NOT_IN_DB(self.db, "account.login",
+                                                 error_message="Taken")))
+        self.table.insert(email="anna@example.com", login="anna")
+        self.table.insert(email="ivan@example.com", login="ivan")
+        self.F = model_form(self.table)
+        del self.queries[:]
+
+    def uniques(self, field):
+        return [x for x in field.validators if isinstance(x, Unique)]
+
+    def test_validators_are_generated(self):
+        form = self.F()
+        self.assertEqual(len(self.uniques(form.email)), 1)
+        self.assertEqual(len(self.uniques(form.login)), 1)
+        self.assertEqual(self.uniques(form.login)[0].message, "Taken")
+
+    def test_not_in_db_is_required_unless_empty_allowed(self):
+        db = self.db
+        converter = ModelConverter()
+        validators, _, required = converter.convert_requires(
+            IS_NOT_IN_DB(db, "account.login"))
+        self.assertTrue(required)
+        validators, _, required = converter.convert_requires(
+            IS_EMPTY_OR(IS_NOT_IN_DB(db, "account.login")))
+        self.assertFalse(required)
+        self.assertIsInstance(validators[0], Unique)
+        # Restricted set is checked by web2py only.
+        validators, _, required = converter.convert_requires(
+            IS_NOT_IN_DB(db(db.account.id > 1), "account.login"))
+        self.assertEqual(validators, [])
+        self.assertTrue(required)
+        form = self.F(DummyPostData(email=["x@y"]))
+        self.assertFalse(form.validate())
+        self.assertEqual(sorted(form.errors), ["login"])
+
+    def test_edited_obj_without_id_field_is_excluded(self):
+        F = model_form(self.table, only=["email", "login"])
+        row = self.table[1]
+        form = F(DummyPostData(email=["anna@example.com"], login=["anna"]),
+                 obj=row)
+        self.assertTrue(form.validate())
+        form = F(DummyPostData(email=["ivan@example.com"], login=["anna"]),
+                 obj=row)
+        self.assertFalse(form.validate())
+        self.assertEqual(sorted(form.errors), ["email"])
+
+    def test_duplicate(self):
+        form = self.F(DummyPostData(email=["anna@example.com"], login=["x"]))
+        self.assertFalse(form.validate())
+        self.assertEqual(sorted(form.errors), ["email"])
+        self.assertEqual(len(self.selects()), 2)
+        self.assertTrue(all("LIMIT 1" in q for q in self.selects()))
+
+    def test_edited_record_is_excluded(self):
+        form = self.F(DummyPostData(id=["1"], email=["anna@example.com"],
+                                    login=["anna"]))
+        self.assertTrue(form.validate())
+        form = self.F(DummyPostData(id=["2"], email=["anna@example.com"],
+                                    login=["ivan"]))
+        self.assertFalse(form.validate())
+
+    def test_batch(self):
+        records = [{"email": "user%d@example.com" % i, "login": "user%d" % i}
+                   for i in range(10)]
+        records.append({"id": "2", "email": "ivan@example.com", "login": "anna"})
+        results = list(validate_records(self.F, records))
+        self.assertEqual([(index, sorted(errors))
+                          for index, data, errors in results if errors],
+                         [(10, ["login"])])
+        self.assertEqual(len(self.selects()), 2)
+        self.assertTrue(all(" IN (" in q for q in self.selects()))
+
+    def test_batch_duplicates(self):
+        records = [{"email": "x@y", "login": "x%d" % i} for i in range(3)]
+        for chunk_size in (1000, 1):
+            results = list(validate_records(self.F, records, chunk_size))
+            self.assertEqual([sorted(errors) for index, data, errors in results],
+                             [[], ["email"], ["email"]])
+
+    def test_batch_of_integer_column_with_bad_input(self):
+        table = self.db.define_table("badge", Field("number", "integer",
+                                                    unique=True))
+        table.insert(number=7)
+        records = [{"number": "abc"}, {"number": "7"}, {"number": "8"}]
+        results = list(validate_records(model_form(table), records))
+        self.assertEqual([sorted(errors) for index, data, errors in results],
+                         [["number"], ["number"], []])
+
+    def test_batch_duplicates_of_invalid_record(self):
+        records = [{"email": "x@y", "login": "anna"},
+                   {"email": "x@y", "login": "x"}]
+        results = list(validate_records(self.F, records))
+        self.assertEqual([sorted(errors) for index, data, errors in results],
+                         [["login"], []])
+
+
+class MemoryCacheTest(unittest.TestCase):
+
+    def test_lru(self):
+        cache = MemoryCache(maxsize=2)
+        cache("a", lambda: 1)
+        cache("b", lambda: 2)
+        cache("a", lambda: None)
+        cache("c", lambda: 3)
+        self.assertEqual(cache("a", lambda: "new"), 1)
+        self.assertEqual(cache("b", lambda: "new"), "new")
+
+    def test_time_expire(self):
+        cache = MemoryCache()
+        cache("a", lambda: 1)
+        self.assertEqual(cache("a", lambda: 2, 3600), 1)
+        self.assertEqual(cache("a", lambda: 2, -1), 2)
+
+    def test_clear(self):
+        cache = MemoryCache()
+        cache("x/1", lambda: 1)
+        cache("y/1", lambda: 1)
+        cache.clear("^x/")
+        self.assertEqual(list(cache.storage), ["y/1"])
+
 
 class TestAllFieldTypes(BaseDALTest):
 
@@ -119,12 +757,24 @@ class TestAllFieldTypes(BaseDALTest):
             Field("date", "date"),
             Field("time", "time"),
             Field("datetime", "datetime"),
+            Field("list_string", "list:string"),
+            Field("list_integer", "list:integer"),
+            Field("list_reference", "list:reference all_field_table"),
         )
         F = model_form(self.table)
         self.form = F()
 
     def test_form_sanity(self):
-        self.assertEqual(len([x for x in self.form]), 10)
+        self.assertEqual(len([x for x in self.form]), 13)
+
+    def test_list_fields(self):
+        self.assertIsInstance(self.form.list_string, ListField)
+        self.assertIsInstance(self.form.list_reference, QuerySelectMultipleField)
+        form = type(self.form)(DummyPostData(list_integer=["1", "", "3"]))
+        self.assertEqual(form.list_integer.data, [1, 3])
+        self.assertEqual(form.list_integer().count("<input"), 3)
+        form = type(self.form)(DummyPostData(list_integer=["x"]))
+        self.assertEqual(form.list_integer.process_errors, ["Not a valid value"])
 
 
 class TestModelForm(BaseDALTest):
@@ -210,6 +860,232 @@ class TestModelFormWithDb(BaseDALTest):
                          [(1, u'Vasya', False), (2, u'Petya', False)])
 
 
+class TestConverterDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.table = DAL(None).define_table(
+            "thing", Field("name"), Field("price", "decimal(10,2)"),
+            Field("note", "text"))
+
+    def test_custom_converters_take_precedence(self):
+        class ByName(FieldConverter):
+            def can_convert(self, field):
+                return field.name == "note"
+            def convert(self, field, kwargs):
+                return self.model_converter.fields.TextField(**kwargs)
+        converter = ModelConverter()
+        converter = ModelConverter(converters=[
+            ByName(converter),
+            SimpleFieldConverter(converter, "string", "TextAreaField")])
+        F = model_form(self.table, converter=converter)
+        self.assertEqual(F.note.field_class.__name__, "TextField")
+        self.assertEqual(F.name.field_class.__name__, "TextAreaField")
+        self.assertEqual(F.price.field_class.__name__, "DecimalField")
+
+    def test_dispatch_is_cached_per_type(self):
+        converter = ModelConverter()
+        model_form(self.table, converter=converter)
+        candidates = converter.converters_for("decimal(10,2)")
+        self.assertEqual(len(candidates), 1)
+        self.assertTrue(candidates[0][1])
+        self.assertTrue(candidates is converter.converters_for("decimal(10,2)"))
+        self.assertEqual(converter.converters_for("unknown"), [])
+
+    def test_converters_added_later_are_used(self):
+        converter = ModelConverter()
+        table = DAL(None).define_table("file", Field("content", "blob"))
+        self.assertFalse(hasattr(model_form(table, converter=converter),
+                                 "content"))
+        converter.converters.append(
+            SimpleFieldConverter(converter, "blob", "TextAreaField"))
+        F = model_form(table, converter=converter)
+        self.assertEqual(F.content.field_class.__name__, "TextAreaField")
+
+
+class TestFormClassCache(unittest.TestCase):
+
+    def define_user(self, *fields):
+        db = DAL(None)
+        return db.define_table("user", Field("name", label="Name"), *fields)
+
+    def test_same_definition_gives_same_class(self):
+        F1 = model_form(self.define_user(), cache=True)
+        F2 = model_form(self.define_user(), cache=True)
+        self.assertTrue(F1 is F2)
+        self.assertFalse(model_form(self.define_user()) is F1)
+
+    def test_definition_changes(self):
+        F1 = model_form(self.define_user(), cache=True)
+        F2 = model_form(self.define_user(Field("age", "integer")), cache=True)
+        F3 = model_form(self.define_user(), cache=True, exclude=["name"])
+        self.assertEqual(len(set([F1, F2, F3])), 3)
+        self.assertTrue(hasattr(F2, "age"))
+        self.assertFalse(hasattr(F3, "name"))
+
+    def test_tables_of_different_databases(self):
+        table = DAL("sqlite:memory").define_table("user", Field("name", label="Name"))
+        F1 = model_form(self.define_user(), cache=True)
+        F2 = model_form(table, cache=True)
+        self.assertFalse(F1 is F2)
+
+    def test_converters_are_compared_by_state(self):
+        def converter(field_type):
+            converter = ModelConverter()
+            converter.converters.insert(
+                0, SimpleFieldConverter(converter, "text", field_type))
+            return converter
+        table = self.define_user(Field("note", "text"))
+        F1 = model_form(table, converter=converter("TextField"), cache=True)
+        F2 = model_form(table, converter=converter("TextAreaField"),
+                        cache=True)
+        self.assertEqual(F1.note.field_class.__name__, "TextField")
+        self.assertEqual(F2.note.field_class.__name__, "TextAreaField")
+        self.assertTrue(model_form(table, converter=converter("TextField"),
+                                   cache=True) is F1)
+
+    def test_requires_bound_to_db_are_not_cached(self):
+        def define_thing():
+            db = DAL("sqlite:memory")
+            db.define_table("color", Field("name"))
+            return db.define_table(
+                "thing", Field("color", requires=IS_IN_DB(db, "color.id")))
+        F1 = model_form(define_thing(), cache=True)
+        F2 = model_form(define_thing(), cache=True)
+        self.assertFalse(F1 is F2)
+
+    def test_in_db_of_request_db_is_cached(self):
+        saved = gluon.current
+        try:
+            classes, choices = [], []
+            for name in ("red", "green"):
+                # Each request defines tables in a new DAL.
+                db = DAL("sqlite:memory")
+                gluon.current = Mock(globalenv={"db": db})
+                db.define_table("color", Field("name"), format="%(name)s")
+                db.define_table("thing", Field("color", "reference color"))
+                db.color.insert(name=name)
+                classes.append(model_form(db.thing, cache=True))
+                choices.append(classes[-1]().color.choices)
+                # Validator of the table is left intact.
+                self.assertTrue(db.thing.color.requires.theset is None)
+        finally:
+            gluon.current = saved
+        self.assertTrue(classes[0] is classes[1])
+        self.assertEqual(choices, [[("", ""), ("1", "red")],
+                                   [("", ""), ("1", "green")]])
+
+
+class TestDeferredChoices(SQLiteDALTest):
+
+    def setUp(self):
+        super(TestDeferredChoices, self).setUp()
+        db = self.db
+        db.define_table("color", Field("name"))
+        db.color.insert(name="red")
+        db.color.insert(name="green")
+        self.table = db.define_table(
+            "thing", Field("color", "integer",
+                           requires=IS_IN_DB(db, "color.id", "%(name)s")))
+        self.queries[:] = []
+
+    def test_defining_form_selects_nothing(self):
+        F = model_form(self.table)
+        F()
+        self.assertEqual(self.selects(), [])
+
+    def test_choices_are_selected_once(self):
+        F = model_form(self.table)
+        form = F(DummyPostData(color=["2"]))
+        self.assertTrue(form.validate())
+        self.assertTrue('<option selected value="2">green</option>' in form.color())
+        self.assertEqual(len(self.selects()), 1)
+
+
+class TestCompiledForms(SQLiteDALTest):
+
+    def setUp(self):
+        super(TestCompiledForms, self).setUp()
+        db = self.db
+        db.define_table("customer", Field("name", required=True),
+                        Field("email", requires=IS_EMAIL()))
+        db.define_table("purchase",
+                        Field("customer", "reference customer"),
+                        Field("price", "decimal(10,2)", default=Decimal("1.5")),
+                        Field("kind", requires=IS_IN_SET(["a", "b"])),
+                        Field("tags", "list:string"))
+        db.define_table("tag", Field("name"), format="%(name)s")
+        db.define_table("tagging", Field("tag", "reference tag"))
+        db.define_table("pick", Field("tag", requires=IS_IN_DB(
+            db(db.tag.id > 0), "tag.id", "%(name)s")))
+
+    def compile(self, *tables):
+        module = imp.new_module("compiled_forms")
+        exec compile_forms(tables) in module.__dict__
+        return module
+
+    def test_same_as_model_form(self):
+        module = self.compile(self.db.customer, self.db.purchase)
+        for table in (self.db.customer, self.db.purchase):
+            compiled = load_form(module, table)
+            self.assertTrue(compiled is module.FORMS[table._tablename])
+            dynamic = model_form(table)
+            formdata = DummyPostData(name=["x"], email=["bad"], price=["2"],
+                                     customer=["1"], kind=["c"])
+            compiled_form, dynamic_form = compiled(formdata), dynamic(formdata)
+            self.assertEqual(compiled_form.validate(), dynamic_form.validate())
+            self.assertEqual(compiled_form.errors, dynamic_form.errors)
+            self.assertEqual(compiled_form.xml(), dynamic_form.xml())
+
+    def test_changed_table_falls_back(self):
+        module = self.compile(self.db.customer)
+        self.db.customer.name.label = "Full name"
+        form_class = load_form(module, self.db.customer)
+        self.assertFalse(form_class is module.FORMS["customer"])
+        self.assertEqual(form_class().name.label.text, "Full name")
+
+    def test_choices_of_restricted_set_are_not_compiled(self):
+        module = self.compile(self.db.tag, self.db.pick)
+        self.assertEqual(sorted(module.FORMS), ["tag"])
+        self.assertTrue("pick" not in module.FINGERPRINTS)
+        self.db.tag.insert(name="red")
+        self.assertEqual(load_form(module, self.db.pick)().tag.choices,
+                         [("", ""), ("1", "red")])
+
+    def test_choices_from_db_are_selected_per_request(self):
+        module = self.compile(self.db.tagging)
+        form_class = load_form(module, self.db.tagging)
+        self.assertTrue(form_class is module.FORMS["tagging"])
+        self.db.tag.insert(name="red")
+        self.assertEqual(form_class().tag.choices, [("", ""), ("1", "red")])
+
+
+class TestLazyModelForm(BaseDALTest):
+
+    def setUp(self):
+        super(TestLazyModelForm, self).setUp()
+        db = self.db = DAL("sqlite:memory", lazy_tables=True)
+        gluon.current = Mock(globalenv={"db": db})
+        db.define_table("company", Field("name"))
+        db.define_table("person", Field("name"), Field("secret", "password"),
+                        Field("company", "reference company"))
+
+    def test_making_form_defines_no_tables(self):
+        F = lazy_model_form(self.db, "person", field_args={
+            "company": {"widget": LazySelect()}})
+        self.assertEqual(sorted(self.db._LAZY_TABLES), ["company", "person"])
+        self.assertEqual(F.name.field_class.__name__, "TextField")
+        self.assertFalse("person" in self.db._LAZY_TABLES)
+
+        form = F()
+        self.assertEqual([f.name for f in form], ["id", "name", "company"])
+        self.db.company.insert(name="Acme")
+        self.assertEqual(form.company(), [(1, u"Acme", False)])
+
+    def test_only(self):
+        F = lazy_model_form(self.db, "person", only=["name"])
+        self.assertEqual([f.name for f in F()], ["name"])
+
+
 class TestValidators(unittest.TestCase):
 
     def setUp(self):
@@ -223,6 +1099,38 @@ class TestValidators(unittest.TestCase):
         names = [v.__class__.__name__ for v in validators]
         self.assertEquals(names, ['IS_LIST_OF', 'IS_IN_SET', 'IS_EMPTY_OR', 'IS_INT_IN_RANGE'])
 
+    def test_unwinding_keeps_requires_intact(self):
+        requires = [IS_EMPTY_OR(IS_INT_IN_RANGE(0, 100))]
+        self.converter.unwind_requires(requires)
+        self.converter.unwind_requires(requires)
+        self.assertEqual(len(requires), 1)
+
+    def test_registry_handles_subclasses(self):
+        class IS_SMALL_INT(IS_INT_IN_RANGE):
+            pass
+        validators, _, _ = self.converter.convert_requires(IS_SMALL_INT(1, 10))
+        self.assertIsInstance(validators[0], v.NumberRange)
+
+    def test_custom_translator(self):
+        registry = default_validator_registry.copy()
+        def translate(w2p_validator, translation):
+            translation.validators.append(v.Email())
+        registry.register(IS_NOT_EMPTY, translate)
+        converter = ModelConverter(validator_registry=registry)
+        validators, _, required = converter.convert_requires(IS_NOT_EMPTY())
+        self.assertIsInstance(validators[0], v.Email)
+        self.assertFalse(required)
+        validators, _, required = self.converter.convert_requires(IS_NOT_EMPTY())
+        self.assertIsInstance(validators[0], v.DataRequired)
+
+    def test_translation_is_cached_per_field(self):
+        field = Field("age", "integer", requires=IS_INT_IN_RANGE(0, 100))
+        result = self.converter.convert_field_requires(field)
+        self.assertTrue(result is self.converter.convert_field_requires(field))
+        field.requires = IS_NOT_EMPTY()
+        validators, _, required = self.converter.convert_field_requires(field)
+        self.assertIsInstance(validators[0], v.DataRequired)
+
     def test_some_more_validators(self):
         validators, _, required = self.converter.convert_requires(IS_INT_IN_RANGE(1, 100))
         self.assertIsInstance(validators[0], v.NumberRange)
@@ -252,6 +1160,341 @@ class DummyField(object):
     iter_choices = lambda x: iter(x.data)
 
 
+class FormRenderingTest(unittest.TestCase):
+
+    class F(Web2pyForm):
+        id = TextField(widget=HiddenInput())
+        name = TextField(u"Имя", validators=[v.Required()])
+
+    def test_xml(self):
+        form = self.F(DummyPostData(id=["1"], name=[""]))
+        form.validate()
+        html = form.xml()
+        self.assertIsInstance(html, str)
+        self.assertEqual(html,
+            '<input id="id" name="id" type="hidden" value="1">'
+            '<div id="name__row"><div class="w2p_fl">'
+            '<label for="name">Имя</label></div><div class="w2p_fw">'
+            '<input id="name" name="name" required type="text" value="">'
+            '<div class="error">This field is required.</div></div></div>')
+
+    def test_static_parts_are_compiled_once(self):
+        self.F().xml()
+        template = self.F._render_templates[""]
+        # Hidden field, label markup, name field, closing tags.
+        self.assertEqual(len(template), 4)
+        form = self.F(prefix="p-", name=u"Вася")
+        self.assertTrue('value="Вася"' in form.xml())
+        self.assertTrue(self.F._render_templates[""] is template)
+        self.assertEqual(sorted(self.F._render_templates), ["", "p-"])
+
+
+class ValidateFieldTest(SQLiteDALTest):
+
+    def setUp(self):
+        super(ValidateFieldTest, self).setUp()
+        self.db.define_table("customer", Field("name"))
+        self.db.define_table("product", Field("name"))
+        self.db.define_table("account", Field("email", unique=True))
+        self.db.customer.insert(name="Anna")
+        self.db.product.insert(name="Soap")
+        self.db.account.insert(email="anna@example.com")
+        db = self.db
+
+        class F(Web2pyForm):
+            name = TextField(validators=[v.Required()])
+            customer = QuerySelectField(query=db.customer)
+            product = QuerySelectField(query=db.product)
+
+            def validate_name(form, field):
+                if field.data == "root":
+                    raise v.ValidationError("Reserved")
+        self.F = F
+        del self.queries[:]
+
+    def test_other_fields_are_not_touched(self):
+        field = self.F.validate_field("name", DummyPostData(name=[""]))
+        self.assertEqual(field.errors, ["This field is required."])
+        field = self.F.validate_field("name", DummyPostData(name=["root"]))
+        self.assertEqual(field.errors, ["Reserved"])
+        self.assertEqual(self.queries, [])
+
+    def test_only_own_queries(self):
+        field = self.F.validate_field("customer", DummyPostData(customer=["1"]))
+        self.assertEqual((field.data, field.errors), (1, []))
+        self.assertEqual(len(self.selects()), 1)
+        self.assertTrue("product" not in self.selects()[0])
+
+    def test_context_fields(self):
+        F = model_form(self.db.account)
+        data = DummyPostData(id=["1"], email=["anna@example.com"])
+        self.assertEqual(F.validate_field("email", data).errors, [])
+        data = DummyPostData(email=["anna@example.com"])
+        self.assertEqual(len(F.validate_field("email", data).errors), 1)
+
+    def test_unknown_field(self):
+        self.assertRaises(KeyError, self.F.validate_field, "nope",
+                          DummyPostData())
+        self.assertRaises(KeyError, self.F.validate_field, "validate_name",
+                          DummyPostData())
+
+
+class SaveTest(SQLiteDALTest):
+
+    def setUp(self):
+        super(SaveTest, self).setUp()
+        self.table = self.db.define_table(
+            "item", Field("name"), Field("qty", "integer"),
+            Field("note", "text"))
+        self.F = model_form(self.table)
+
+    def writes(self):
+        return [q for q in self.queries if q.startswith(("INSERT", "UPDATE"))]
+
+    def test_insert(self):
+        form = self.F(DummyPostData(name=[u"Мыло"], qty=["3"]))
+        self.assertTrue(form.validate())
+        record_id = form.save()
+        row = self.table[record_id]
+        self.assertEqual((row.name, row.qty), ("Мыло", 3))
+
+    def test_update_changed_columns_only(self):
+        record_id = self.table.insert(name="Мыло", qty=3)
+        row = self.table[record_id]
+        del self.queries[:]
+        form = self.F(DummyPostData(id=[str(record_id)], name=[u"Мыло"],
+                                    qty=["5"], note=[""]), obj=row)
+        self.assertEqual(form.changed_data(), {"qty": 5})
+        self.assertEqual(form.save(), record_id)
+        self.assertEqual(len(self.writes()), 1)
+        self.assertTrue("qty=5" in self.writes()[0].replace(" ", ""))
+        self.assertFalse("name" in self.writes()[0])
+        self.assertEqual(self.table[record_id].qty, 5)
+
+    def test_unchanged_is_not_written(self):
+        record_id = self.table.insert(name="Soap", qty=3)
+        row = self.table[record_id]
+        del self.queries[:]
+        form = self.F(DummyPostData(id=[str(record_id)], name=["Soap"],
+                                    qty=["3"]), obj=row)
+        self.assertEqual(form.save(), record_id)
+        self.assertEqual(self.writes(), [])
+
+    def test_cleared_column_is_written(self):
+        record_id = self.table.insert(name="Soap", qty=3, note="old")
+        form = self.F(DummyPostData(id=[str(record_id)], name=["Soap"],
+                                    qty=["3"], note=[""]),
+                      obj=self.table[record_id])
+        self.assertEqual(form.changed_data(), {"note": ""})
+        form.save()
+        self.assertEqual(self.table[record_id].note, "")
+
+    def test_posted_id_must_match_record(self):
+        first = self.table.insert(name="Soap", qty=3)
+        second = self.table.insert(name="Brush", qty=1)
+        form = self.F(DummyPostData(id=[str(second)], name=["mallory"],
+                                    qty=["0"]), obj=self.table[first])
+        self.assertRaises(ValueError, form.save)
+        self.assertEqual(self.table[second].name, "Brush")
+        self.assertEqual(self.table[first].name, "Soap")
+
+    def test_update_needs_record(self):
+        record_id = self.table.insert(name="Soap", qty=3)
+        form = self.F(DummyPostData(id=[str(record_id)], name=["x"]))
+        self.assertRaises(ValueError, form.save)
+        self.assertRaises(ValueError, form.changed_data)
+        self.assertEqual(self.table[record_id].name, "Soap")
+
+    def test_bulk_insert(self):
+        forms = [self.F(DummyPostData(name=["item%d" % i], qty=[str(i)]))
+                 for i in range(5)]
+        ids = self.F.bulk_insert(forms, batch_size=2)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(self.db(self.table).count(), 5)
+        self.assertEqual(self.table[ids[4]].qty, 4)
+
+    def test_form_without_table(self):
+        self.assertRaises(ValueError, Web2pyForm().save)
+
+
+class FormStatsTest(SQLiteDALTest):
+
+    def setUp(self):
+        super(FormStatsTest, self).setUp()
+        self.db.define_table("customer", Field("name"))
+        for name in ("Anna", "Ivan"):
+            self.db.customer.insert(name=name)
+        self.events = []
+        stats.add_observer(self.events.append)
+
+    def tearDown(self):
+        stats.remove_observer(self.events.append)
+        super(FormStatsTest, self).tearDown()
+
+    def make_form(self):
+        class F(Web2pyForm):
+            name = TextField(validators=[v.Required()])
+            customer = QuerySelectField(query=self.db.customer)
+        return F
+
+    def test_phases_are_reported(self):
+        F = self.make_form()
+        form = F(DummyPostData(name=["x"], customer=["1"]))
+        self.assertTrue(form.validate())
+        form.xml()
+        phases = set((e["phase"], e["field"]) for e in self.events)
+        for phase in ("process", "validate", "render"):
+            self.assertTrue((phase, None) in phases)
+        self.assertTrue(("validate", "name") in phases)
+        self.assertTrue(("render", "customer") in phases)
+        self.assertEqual(set(e["form"] for e in self.events), set(["F"]))
+
+    def test_queries_are_counted_per_field(self):
+        F = self.make_form()
+        form = F(DummyPostData(name=["x"], customer=["1"]))
+        form.validate()
+        form.xml()
+        self.assertEqual(form.stats.queries, {"customer": 1})
+        self.assertEqual(form.stats.total_queries, 1)
+        self.assertEqual([e["queries"] for e in self.events
+                          if e["phase"] == "query"], [1])
+
+    def test_convert_is_reported(self):
+        model_form(self.db.customer)
+        self.assertEqual([(e["form"], e["phase"]) for e in self.events],
+                         [("CustomerForm", "convert")])
+
+    def test_nothing_measured_without_observers(self):
+        stats.remove_observer(self.events.append)
+        try:
+            form = self.make_form()(DummyPostData(name=[""]))
+            self.assertFalse(form.validate())
+            form.xml()
+            self.assertTrue(form.stats is None)
+        finally:
+            stats.add_observer(self.events.append)
+
+
+class ConstraintsTest(BaseDALTest):
+
+    def setUp(self):
+        super(ConstraintsTest, self).setUp()
+        self.table = self.db.define_table(
+            "person",
+            Field("name", requires=[IS_NOT_EMPTY(), IS_LENGTH(20)]),
+            Field("email", requires=IS_EMAIL()),
+            Field("age", "integer", requires=IS_INT_IN_RANGE(0, 150)),
+            Field("gender", requires=IS_IN_SET(["f", "m"])),
+        )
+        self.F = model_form(self.table)
+
+    def test_html_attributes(self):
+        form = self.F()
+        self.assertTrue(' maxlength="20" ' in form.name.xml())
+        self.assertTrue(' required ' in form.name.xml())
+        self.assertTrue('type="email"' in form.email.xml())
+        self.assertTrue('max="149" min="0" ' in form.age.xml())
+        self.assertTrue('type="number"' in form.age.xml())
+        self.assertFalse('step=' in form.age.xml())
+        self.assertFalse('min=' in form.id.xml())
+
+    def test_decimal_range_allows_fractions(self):
+        table = self.db.define_table(
+            "item", Field("price", "double",
+                          requires=IS_FLOAT_IN_RANGE(0, 100)))
+        html = model_form(table)().price.xml()
+        self.assertTrue('type="number"' in html)
+        self.assertTrue('step="any"' in html)
+        self.assertFalse('maxlength=' in html)
+
+    def test_json_schema(self):
+        schema = json.loads(self.F.json_schema())
+        self.assertEqual(schema["required"], ["name"])
+        self.assertEqual(schema["properties"]["name"],
+                         {"type": "string", "maxLength": 20})
+        self.assertEqual(schema["properties"]["email"]["format"], "email")
+        self.assertEqual(schema["properties"]["age"],
+                         {"type": "integer", "minimum": 0, "maximum": 149})
+        self.assertEqual(sorted(schema["properties"]),
+                         ["age", "email", "gender", "id", "name"])
+        self.assertEqual(schema["properties"]["gender"]["enum"],
+                         ["", "f", "m"])
+        self.assertTrue(self.F.json_schema() is self.F.json_schema())
+
+    def test_static_choices_enum(self):
+        class F(Web2pyForm):
+            s = SelectField(choices=[("a", "A"), ("b", "B")])
+        schema = json.loads(F.json_schema())
+        self.assertEqual(schema["properties"]["s"],
+                         {"type": "string", "enum": ["a", "b"]})
+
+
+class FormSelectRenderingTest(SQLiteDALTest):
+
+    def setUp(self):
+        super(FormSelectRenderingTest, self).setUp()
+        self.db.define_table("customer", Field("name"))
+        self.db.customer.insert(name="Anna")
+        db = self.db
+
+        class F(Web2pyForm):
+            name = TextField(u"Name")
+            kind = SelectField(choices=[("a", "A"), ("b", "B")])
+            customer = QuerySelectField(query=db.customer)
+        self.F = F
+
+    def test_xml_with_selects(self):
+        html = self.F(kind="b").xml()
+        self.assertTrue('<div id="kind__row">' in html)
+        self.assertTrue('<option selected value="b">B</option>' in html)
+        self.assertTrue('<option value="1">Anna</option>' in html)
+
+    def test_label_changed_on_instance(self):
+        self.F().xml()
+        form = self.F()
+        form.name.label.text = "CHANGED"
+        self.assertTrue('<label for="name">CHANGED</label>' in form.xml())
+        self.assertTrue('<label for="name">Name</label>' in self.F().xml())
+
+    def test_field_deleted_on_instance(self):
+        self.F().xml()
+        form = self.F()
+        del form.kind
+        html = form.xml()
+        self.assertFalse('kind__row' in html)
+        self.assertTrue('<div id="kind__row">' in self.F().xml())
+
+    def test_widget_changed_on_instance(self):
+        self.F().xml()
+        form = self.F()
+        form.name.widget = HiddenInput()
+        html = form.xml()
+        self.assertFalse('name__row' in html)
+        self.assertTrue('type="hidden"' in html)
+        self.assertTrue('<div id="name__row">' in self.F().xml())
+
+
+class StreamingSelectTest(unittest.TestCase):
+
+    class F(Form):
+        s = SelectField(choices=[("1", "One"), ("<2>", '"Two" & <b>'),
+                                 ("3", str("Три")), ("4", u"Четыре")],
+                        default="<2>")
+
+    def test_same_html_as_select(self):
+        field = self.F().s
+        self.assertEqual(StreamingSelect()(field), Select()(field))
+        self.assertEqual(StreamingSelect(multiple=True)(field, size=3),
+                         Select(multiple=True)(field, size=3))
+
+    def test_xml(self):
+        class F(Form):
+            s = SelectField(choices=[("1", u"Один")], widget=StreamingSelect())
+        html = F().s.xml()
+        self.assertIsInstance(html, str)
+        self.assertTrue(str('<option value="1">Один</option>') in html)
+
+
 class EncodingIssuesTest(unittest.TestCase):
 
     class F(Form):
@@ -263,6 +1506,30 @@ class EncodingIssuesTest(unittest.TestCase):
         html = TextInput()(field)
         self.assertIsInstance(html, unicode)
 
+    def test_text_type(self):
+        utf8 = str('ыыы')
+        text = text_type(utf8)
+        self.assertEqual(text, u'ыыы')
+        self.assertTrue(str(text) is utf8)
+        self.assertTrue(text_type(text) is text)
+        self.assertEqual(text_type(u'ыыы'), u'ыыы')
+        self.assertEqual(text_type(42), u'42')
+        encoded = str(text_type(u'ыыы'))
+        self.assertEqual(encoded, utf8)
+
+    def test_encoded_once(self):
+        text = text_type(u'ыыы')
+        self.assertTrue(str(text) is str(text))
+
+    def test_pickle(self):
+        text = text_type(u'ыыы')
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            for module in (pickle, cPickle):
+                copy = module.loads(module.dumps(text, protocol))
+                self.assertEqual(copy, text)
+                self.assertIsInstance(copy, text_type)
+                self.assertEqual(str(copy), str('ыыы'))
+
     def test_wtforms_to_web2py(self):
         # web2py expects that field's .xml() method returns `str`
         field = self.F().a
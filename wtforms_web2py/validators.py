@@ -0,0 +1,130 @@
+from wtforms.validators import ValidationError
+
+from .fields import db_for
+from .stats import timed_query
+from .utils import force_unicode
+
+
+def _key(value):
+    return force_unicode(value)
+
+
+def _representable(db, column, value):
+    try:
+        db._adapter.represent(value, column.type)
+    except (TypeError, ValueError, ArithmeticError):
+        return False
+    return True
+
+
+class Unique(object):
+
+    """
+    Checks that no other row of table `tablename` has field data in column
+    `fieldname`, like web2py's IS_NOT_IN_DB.
+
+    The row being edited, given by data of form field `id_field`, or by the
+    `obj` the form was processed with if the form has no such field, is not
+    counted.  Each value is checked by one ``limitby=(0, 1)`` select on the
+    (presumably indexed) column, unless it was selected along with other
+    values by `prefetch()`.  Values taken by `reserve()` fail too.  Empty
+    values and `allowed` ones pass.
+    """
+    field_flags = ('unique',)
+
+    def __init__(self, tablename, fieldname, message=None, id_field='id',
+                 allowed=(), db=None):
+        self.tablename = tablename
+        self.fieldname = fieldname
+        self.message = message
+        self.id_field = id_field
+        self.allowed = allowed
+        self.db = db
+
+    def _record_id(self, form):
+        if not self.id_field:
+            return None
+        field = form._fields.get(self.id_field)
+        if field is not None:
+            return field.data
+        # E.g. edit form made with ``only=``, see `form.Form.process()`.
+        return getattr(getattr(form, '_obj', None), self.id_field, None)
+
+    def _skips(self, value):
+        return value is None or value == '' or value in self.allowed
+
+    def _found(self, field):
+        return getattr(field, '_unique_found', {}).get(
+            (self.tablename, self.fieldname))
+
+    def _reserved(self, field):
+        if not hasattr(field, '_unique_reserved'):
+            field._unique_reserved = {}
+        return field._unique_reserved.setdefault(
+            (self.tablename, self.fieldname), {})
+
+    def reserve(self, field, value, record_id=None):
+        """
+        Counts `value` as taken by record `record_id` (a new one if None) in
+        checks of bound `field` from now on, e.g. by a record validated
+        earlier in `batch.validate_records()` but not inserted yet.
+        """
+        if self._skips(value):
+            return
+        if record_id is None:
+            # Each new record is a different one.
+            record_id = object()
+        self._reserved(field).setdefault(_key(value), set()).add(record_id)
+
+    def prefetch(self, field, values):
+        """
+        Selects ids of rows having any of `values` with one ``belongs()``
+        query and keeps them on bound `field`, so the values are then checked
+        without querying, e.g. in `batch.validate_records()`.
+        """
+        db = db_for(self.db, "validation")
+        table = db[self.tablename]
+        column = table[self.fieldname]
+        # Values are raw input; ones the column can't hold, e.g. "abc" of an
+        # integer column, are left to validation of their records.
+        values = set(x for x in values if x not in (None, '') and
+                     _representable(db, column, x))
+        if not values:
+            return
+        with timed_query(field):
+            rows = db(column.belongs(values)).select(
+                table._id, column, cacheable=True)
+        found = dict((_key(x), set()) for x in values)
+        for row in rows:
+            found.setdefault(_key(row[self.fieldname]), set()).add(
+                row[table._id.name])
+        if not hasattr(field, '_unique_found'):
+            field._unique_found = {}
+        field._unique_found.setdefault(
+            (self.tablename, self.fieldname), {}).update(found)
+
+    def exists(self, field, value, record_id=None):
+        reserved = self._reserved(field).get(_key(value))
+        if reserved and reserved - set([record_id]):
+            return True
+        found = self._found(field)
+        if found is not None and _key(value) in found:
+            return bool(found[_key(value)] - set([record_id]))
+        db = db_for(self.db, "validation")
+        table = db[self.tablename]
+        query = table[self.fieldname] == value
+        if record_id:
+            query &= table._id != record_id
+        with timed_query(field):
+            rows = db(query).select(table._id, limitby=(0, 1), cacheable=True)
+        return bool(rows)
+
+    def __call__(self, form, field):
+        value = field.data
+        if self._skips(value):
+            return
+        if self.exists(field, value, self._record_id(form)):
+            message = self.message
+            if message is None:
+                message = field.gettext('Value already exists.')
+            raise ValidationError(message)
@@ -0,0 +1,47 @@
+from cgi import escape
+
+from wtforms.widgets import HTMLString, Select, html_params
+
+from .utils import force_unicode
+
+
+class StreamingSelect(Select):
+
+    """
+    Renders the same HTML as `wtforms.widgets.Select`, but formats options
+    straight into one buffer, without intermediate `HTMLString` and
+    attribute dict per option.
+    """
+
+    def __call__(self, field, **kwargs):
+        kwargs.setdefault('id', field.id)
+        if self.multiple:
+            kwargs['multiple'] = True
+        html = [u'<select %s>' % html_params(name=field.name, **kwargs)]
+        append = html.append
+        for val, label, selected in field.iter_choices():
+            append(u'<option %svalue="%s">%s</option>' % (
+                u'selected ' if selected else u'',
+                escape(force_unicode(val), quote=True),
+                escape(force_unicode(label))))
+        append(u'</select>')
+        return HTMLString(u''.join(html))
+
+
+class ListInput(object):
+
+    """
+    Text input per item of a list, like web2py's list widget.  One empty
+    input is always added for a new item.
+    """
+
+    def __call__(self, field, **kwargs):
+        kwargs.setdefault('id', field.id)
+        html = [u'<ul %s>' % html_params(id='%s_grow_input' % kwargs.pop('id'),
+                                         style='list-style:none')]
+        for value in list(field.data or ()) + [u'']:
+            html.append(u'<li><input %s></li>' % html_params(
+                name=field.name, type='text', value=force_unicode(value),
+                **kwargs))
+        html.append(u'</ul>')
+        return HTMLString(u''.join(html))